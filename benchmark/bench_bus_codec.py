@@ -0,0 +1,64 @@
+"""
+消息总线codec benchmark: 每条消息的字节数与编解码耗时。
+
+    python -m benchmark.bench_bus_codec
+"""
+import json
+import time
+import pickle
+from db.tables import DMKSource
+from utils.udp import CODECS, Codec, PickleCodec
+from benchmark.ws_frames import gen_danmaku
+
+ROUNDS = 2000
+
+
+def gen_messages():
+    ts = int(time.time())
+    guard = {
+        "cmd": "GUARD_LOTTERY_START",
+        "data": {"id": 2345678, "roomid": 1016, "message": "恭喜 xxx 开通舰长", "type": "guard",
+                 "privilege_type": 3, "link": "", "payflow_id": "abc", "lottery": {
+                     "id": 2345678, "sender": {"uid": 1, "uname": "user", "face": "http://i0.hdslb.com/face.jpg"},
+                     "keyword": "guard", "privilege_type": 3, "time": 1200, "status": 1, "mobile_display_mode": 2,
+                     "mobile_static_asset": "", "mobile_animation_asset": ""}},
+    }
+    return {
+        "T (no payload)": [DMKSource(prize_type="T", room_id=1016)],
+        "D": [DMKSource(prize_type="D", room_id=1016, danmaku=gen_danmaku(1), ts=ts)],
+        "G": [DMKSource(prize_type="G", room_id=1016, danmaku=guard, ts=ts)],
+        "G x 64": [DMKSource(prize_type="G", room_id=1016, danmaku=json.loads(json.dumps(guard)), ts=ts) for _ in range(64)],
+    }
+
+
+def main():
+    for name, messages in gen_messages().items():
+        print(f"{name}:")
+        for codec in (PickleCodec(), *CODECS.values()):
+            data = codec.encode(messages)
+            if isinstance(codec, PickleCodec):
+                # 接收端不解码pickle，这里直接pickle.loads作为对比基准
+                body = data[Codec.header.size:]
+                decode = lambda: pickle.loads(body)
+            else:
+                decode = lambda: Codec.decode(data)
+            assert [m.dict() for m in decode()] == [m.dict() for m in messages]
+
+            start = time.perf_counter()
+            for _ in range(ROUNDS):
+                codec.encode(messages)
+            encode_cost = (time.perf_counter() - start) / ROUNDS / len(messages) * 1e6
+
+            start = time.perf_counter()
+            for _ in range(ROUNDS):
+                decode()
+            decode_cost = (time.perf_counter() - start) / ROUNDS / len(messages) * 1e6
+
+            print(
+                f"\t{codec.__class__.__name__:<14} {len(data) / len(messages):8.1f} bytes/event, "
+                f"encode {encode_cost:7.2f} us, decode {decode_cost:7.2f} us"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+raffle Executor 回放 benchmark。
+
+ws帧经 danmaku_parser_process 解析为 DMKSource，再逐条交给 Executor.run，统计各handler耗时。
+redis、mysql、B站API与QQ通知替换为内存中的stub，io_delay(毫秒)模拟每次IO的耗时。
+
+    python -m benchmark.bench_raffle_executor [frame_file] [io_delay]
+"""
+import sys
+import time
+import asyncio
+import lt.aio_ws_source as ws_source
+import lt.lt_proc_raffle as proc_raffle
+from lt.aio_ws_source import DanmakuQueue, danmaku_parser_process
+from lt.lt_proc_raffle import Executor
+from db.tables import DMKSource
+from benchmark.ws_frames import gen_frame, gen_lottery, load_frames
+
+IO_DELAY = 0.0
+
+
+class Stub:
+    """ 任意异步方法调用都返回 returns 中的值，默认None """
+
+    def __init__(self, **returns):
+        self._returns = returns
+
+    def __getattr__(self, name):
+        result = self._returns.get(name)
+
+        async def method(*args, **kwargs):
+            if IO_DELAY:
+                await asyncio.sleep(IO_DELAY)
+            return result
+        return method
+
+
+def install_stubs():
+    proc_raffle.redis_cache = Stub()
+    proc_raffle.RaffleDeDup = Stub(add=True)
+    proc_raffle.RedisGuard = Stub()
+    proc_raffle.RedisRaffle = Stub()
+    proc_raffle.RedisAnchor = Stub()
+    proc_raffle.InLotteryLiveRooms = Stub()
+    proc_raffle.Guard = Stub()
+    proc_raffle.Raffle = Stub()
+    proc_raffle.async_zy = Stub()
+    proc_raffle.BiliApi = Stub(lottery_check=(True, ([], [])))
+
+
+class Collector:
+    def __init__(self):
+        self.messages = []
+
+    def put_nowait(self, message):
+        self.messages.append(message)
+
+
+async def replay_source(frames) -> list:
+    collector = Collector()
+    ws_source.mq_source_to_raffle = collector
+    q = DanmakuQueue()
+    for frame in frames:
+        q.put_nowait((int(time.time()), 1016, frame))
+
+    task = asyncio.create_task(danmaku_parser_process(q))
+    while q.qsize():
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.01)
+    task.cancel()
+    return collector.messages
+
+
+async def main():
+    global IO_DELAY
+    if len(sys.argv) > 2:
+        IO_DELAY = float(sys.argv[2]) / 1000
+    if len(sys.argv) > 1 and sys.argv[1] != "-":
+        frames = load_frames(sys.argv[1])
+    else:
+        frames = [gen_frame(60, gen=gen_lottery) for _ in range(50)]
+
+    install_stubs()
+    messages = await replay_source(frames)
+    messages += [DMKSource(prize_type="T", room_id=1016, ts=int(time.time())) for _ in range(len(messages) // 6)]
+    print(f"{len(frames)} frames -> {len(messages)} messages, io delay: {IO_DELAY * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    for message in messages:
+        await Executor(message).run()
+    await proc_raffle.write_behind.flush()
+    cost = time.perf_counter() - start
+    print(f"executor: {len(messages) / cost:10.0f} msgs/s")
+
+    for prize_type, recorder in Executor.timings.items():
+        t = recorder.snapshot()
+        if t["count"]:
+            print(
+                f"{prize_type:<13} {t['count']:>6} msgs, p50: {t['p50'] * 1e6:8.1f} us, "
+                f"p99: {t['p99'] * 1e6:8.1f} us, max: {t['max'] * 1e6:8.1f} us"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
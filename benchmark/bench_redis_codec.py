@@ -0,0 +1,75 @@
+"""
+redis值编码 benchmark: 对实际写入redis的数据比较各codec的编码/解码耗时与存储字节数。
+
+    python -m benchmark.bench_redis_codec [rounds]
+"""
+import sys
+import time
+import datetime
+from db.tables import RaffleBroadCast
+from utils.redis_codec import CODECS, get_codec
+
+
+def gen_payloads() -> dict:
+    now = datetime.datetime.now()
+    guard = {
+        "gift_id": 2518839,
+        "room_id": 1016,
+        "gift_name": "总督",
+        "sender_uid": 20932326,
+        "sender_name": "偷闲一天打个盹",
+        "sender_face": "http://i0.hdslb.com/bfs/face/member/noface.jpg",
+        "created_time": now,
+        "expire_time": now + datetime.timedelta(seconds=1200),
+    }
+    broadcast = RaffleBroadCast(
+        raffle_type="tv",
+        ts=int(time.time()),
+        real_room_id=1016,
+        raffle_id=597438,
+        gift_name="小电视飞船",
+        created_time=now,
+        expire_time=now + datetime.timedelta(seconds=120),
+        gift_type="GIFT_30035",
+        time_wait=60,
+        max_time=120,
+    )
+    return {
+        "GIFT_TYPE (str)": ("GIFT_TYPE_GIFT_30035", "小电视飞船"),
+        "LT_GUARD (dict)": ("LT_GUARD_H", guard),
+        "LTS:RF_BR (model)": ("LTS:RF_BR", broadcast),
+        "counter (int)": ("LT_COUNTER", 123456789),
+    }
+
+
+def bench(codec, value, rounds):
+    data = codec.dumps(value)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.dumps(value)
+    encode = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        codec.loads(data)
+    decode = (time.perf_counter() - start) / rounds
+    return encode, decode, len(data)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for name, (_, value) in gen_payloads().items():
+        print(name)
+        for codec_name in CODECS:
+            if codec_name == "int" and not isinstance(value, int):
+                continue
+            try:
+                encode, decode, size = bench(get_codec(codec_name), value, rounds)
+            except TypeError as e:
+                print(f"    {codec_name:<8} unsupported: {e}")
+                continue
+            print(f"    {codec_name:<8} encode {encode * 1e6:7.2f} us, decode {decode * 1e6:7.2f} us, {size:5d} bytes")
+
+
+if __name__ == "__main__":
+    main()
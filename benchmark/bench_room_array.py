@@ -0,0 +1,73 @@
+"""
+房间号集合存储与集合运算 benchmark: "_"连接字符串 / pickle set vs room_array。
+
+    python -m benchmark.bench_room_array [count]
+"""
+import sys
+import time
+import pickle
+from random import sample
+from utils import room_array
+from utils.dao import ValuableLiveRoom
+
+
+def timeit(func, rounds=20):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = func()
+    return (time.perf_counter() - start) / rounds, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    valuable = sample(range(1, 30000000), count)
+    monitor = set(sample(range(1, 30000000), count * 2 // 3)) | set(valuable[:count // 3])
+    print(f"valuable: {len(valuable)}, monitor: {len(monitor)}, numpy: {room_array.numpy is not None}")
+
+    legacy_str = "_".join(str(r) for r in valuable).encode()
+    packed = room_array.pack(valuable)
+    cost, _ = timeit(lambda: "_".join(str(r) for r in valuable).encode())
+    print(f"valuable  string  encode {cost * 1000:7.2f} ms, {len(legacy_str):7d} bytes")
+    cost, _ = timeit(lambda: ValuableLiveRoom._parse_legacy(legacy_str))
+    print(f"valuable  string  decode {cost * 1000:7.2f} ms")
+    cost, _ = timeit(lambda: room_array.pack(valuable))
+    print(f"valuable  packed  encode {cost * 1000:7.2f} ms, {len(packed):7d} bytes")
+    cost, _ = timeit(lambda: room_array.unpack(packed))
+    print(f"valuable  packed  decode {cost * 1000:7.2f} ms")
+
+    pickled = pickle.dumps(monitor)
+    packed = room_array.pack(monitor, sort=True)
+    cost, _ = timeit(lambda: pickle.dumps(monitor))
+    print(f"monitor   pickle  encode {cost * 1000:7.2f} ms, {len(pickled):7d} bytes")
+    cost, _ = timeit(lambda: pickle.loads(pickled))
+    print(f"monitor   pickle  decode {cost * 1000:7.2f} ms")
+    cost, _ = timeit(lambda: room_array.pack(monitor, sort=True))
+    print(f"monitor   packed  encode {cost * 1000:7.2f} ms, {len(packed):7d} bytes")
+    cost, _ = timeit(lambda: room_array.unpack(packed))
+    print(f"monitor   packed  decode {cost * 1000:7.2f} ms")
+
+    # update_connection: expected = monitor | valuable, 与已有连接求差集
+    existed = set(sample(sorted(monitor), len(monitor) // 2))
+
+    def with_sets():
+        expected = pickle.loads(pickled) | set(ValuableLiveRoom._parse_legacy(legacy_str))
+        return expected - existed, existed - expected
+
+    existed_arr = room_array.to_sorted(existed)
+    packed_valuable = room_array.pack(valuable)
+
+    def with_arrays():
+        expected = room_array.union(
+            room_array.unpack(packed), room_array.to_sorted(room_array.unpack(packed_valuable))
+        )
+        return room_array.difference(expected, existed_arr), room_array.difference(existed_arr, expected)
+
+    cost, (add_s, del_s) = timeit(with_sets)
+    print(f"update    sets    {cost * 1000:7.2f} ms")
+    cost, (add_a, del_a) = timeit(with_arrays)
+    print(f"update    arrays  {cost * 1000:7.2f} ms")
+    assert set(add_a) == add_s and set(del_a) == del_s
+
+
+if __name__ == "__main__":
+    main()
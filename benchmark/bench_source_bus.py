@@ -0,0 +1,54 @@
+"""
+source -> raffle 消息总线 benchmark: UDP + 每条pickle vs Unix域socket批量发送。
+
+    python -m benchmark.bench_source_bus [count]
+"""
+import sys
+import time
+import asyncio
+from db.tables import DMKSource
+from utils.udp import UdpClient, UdpServer, UnixSocketBus
+from benchmark.ws_frames import gen_danmaku
+
+
+async def bench(name, sender, receiver, messages):
+    await receiver.start_listen()
+    start = time.perf_counter()
+    received = 0
+    end = start
+
+    async def receive():
+        nonlocal received, end
+        while True:
+            await receiver.get()
+            received += 1
+            end = time.perf_counter()
+
+    task = asyncio.create_task(receive())
+    for i, m in enumerate(messages):
+        sender.put_nowait(m)
+        if i % 200 == 0:
+            await asyncio.sleep(0)
+
+    last = -1
+    while received != last and received < len(messages):
+        last = received
+        await asyncio.sleep(0.2)
+    cost = end - start
+    task.cancel()
+    print(f"{name:<10} received {received}/{len(messages)}, {received / cost:10.0f} events/s")
+
+
+async def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    messages = [
+        DMKSource(prize_type="D", room_id=i, danmaku=gen_danmaku(i), ts=int(time.time()))
+        for i in range(count)
+    ]
+    await bench("udp", UdpClient(port=40100), UdpServer(port=40100), messages)
+    bus = UnixSocketBus(path="/tmp/stormgift_bench_bus.sock")
+    await bench("unix bus", bus, bus, messages)
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,134 @@
+"""
+ws连接调度 benchmark: 旧版每房间 读取Task + 心跳Task vs 时间轮。
+
+不建立真实网络连接，用内存中的假ws模拟；心跳间隔缩短到1秒以放大计时器开销。
+
+    python -m benchmark.bench_ws_mux [seconds]
+"""
+import sys
+import time
+import asyncio
+import subprocess
+import lt.aio_ws_source as ws_source
+from lt.aio_ws_source import ClientsManager, WsClient
+
+HEART_BEAT_INTERVAL = 1
+
+
+class FakeMsg:
+    __slots__ = ("type", "data")
+
+    def __init__(self, type_, data=None):
+        self.type = type_
+        self.data = data
+
+
+class FakeWs:
+    def __init__(self):
+        self.closed = False
+        self.sent = 0
+        self._closed_future = asyncio.get_event_loop().create_future()
+
+    async def send_bytes(self, data):
+        self.sent += 1
+
+    async def receive(self):
+        await self._closed_future
+        return FakeMsg(ws_source.aiohttp.WSMsgType.CLOSED)
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            if not self._closed_future.done():
+                self._closed_future.set_result(None)
+
+
+class FakeSession:
+    closed = False
+
+    async def ws_connect(self, url):
+        return FakeWs()
+
+    async def close(self):
+        pass
+
+
+class LegacyWsClient:
+    """ 旧版模型: 每个房间一个读取Task和一个心跳Task """
+
+    def __init__(self, room_id, session):
+        self.room_id = room_id
+        self.session = session
+        self.task = None
+        self.task_heartbeat = None
+
+    async def _listen(self):
+        ws_conn = await self.session.ws_connect(url="")
+        await ws_conn.send_bytes(b"")
+
+        async def heart_beat():
+            while True:
+                await asyncio.sleep(HEART_BEAT_INTERVAL)
+                if not ws_conn.closed:
+                    await ws_conn.send_bytes(b"")
+
+        self.task_heartbeat = asyncio.create_task(heart_beat())
+        while True:
+            await ws_conn.receive()
+
+    async def connect(self):
+        self.task = asyncio.create_task(self._listen())
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+async def run_case(model, count, seconds):
+    session = FakeSession()
+    base_rss = rss_mb()
+
+    if model == "legacy":
+        clients = [LegacyWsClient(room_id, session) for room_id in range(count)]
+        for ws in clients:
+            await ws.connect()
+    else:
+        ws_source.HEART_BEAT_INTERVAL = HEART_BEAT_INTERVAL
+        manager = ClientsManager(asyncio.Queue())
+        for room_id in range(count):
+            ws = WsClient(room_id=room_id, mux=manager, session=session)
+            await ws.connect()
+        asyncio.create_task(manager.drive_timer_wheel())
+
+    await asyncio.sleep(0.1)
+    tasks = len(asyncio.all_tasks())
+    cpu_start = time.process_time()
+    await asyncio.sleep(seconds)
+    cpu = time.process_time() - cpu_start
+    print(f"{model:<8} {count:>6} conns: tasks {tasks:>6}, rss +{rss_mb() - base_rss:7.1f} MB, cpu {cpu:6.2f} s")
+
+    # 退出前取消所有读取/心跳/时间轮Task
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    for t in pending:
+        t.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    if len(sys.argv) > 3:
+        model, count = sys.argv[2], int(sys.argv[3])
+        asyncio.get_event_loop().run_until_complete(run_case(model, count, seconds))
+        return
+
+    for count in (5000, 15000, 30000):
+        for model in ("legacy", "wheel"):
+            subprocess.run([sys.executable, "-m", "benchmark.bench_ws_mux", str(seconds), model, str(count)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+WsApi.parse_msg benchmark.
+
+    python -m benchmark.bench_ws_parse [frames_file]
+
+不指定帧文件时使用生成的帧。
+"""
+import sys
+import zlib
+import json
+import time
+from utils.biliapi import WsApi, DanmakuFilter
+from benchmark.ws_frames import WATCHED_UIDS, gen_frames, load_frames
+
+
+def legacy_parse_msg(message):
+    """ 旧版实现: 每个子包都对剩余buffer切片 """
+    result = []
+    while message:
+        len_data, len_header, ver, opt, seq = WsApi.structure.unpack_from(message)
+        data = message[len_header:len_data]
+        message = message[len_data:]
+        if opt == 5:
+            if ver == 2:
+                data = zlib.decompress(data)
+                while data:
+                    len_data, len_header, ver, opt, seq = WsApi.structure.unpack_from(data[:16])
+                    result.append(json.loads(data[len_header:len_data]))
+                    data = data[len_data:]
+            else:
+                result.append(json.loads(data))
+    return result
+
+
+def bench(name, func, frames, rounds):
+    start = time.perf_counter()
+    count = 0
+    for _ in range(rounds):
+        for frame in frames:
+            count += len(func(frame))
+    cost = time.perf_counter() - start
+    print(f"{name:<16} {cost * 1000:9.2f} ms, {count / cost:12.0f} msg/s")
+    return cost, count // rounds
+
+
+def main():
+    if len(sys.argv) > 1:
+        frames = load_frames(sys.argv[1])
+        rounds = 20
+    else:
+        frames = gen_frames()
+        rounds = 50
+
+    for frame in frames:
+        assert WsApi.parse_msg(frame) == legacy_parse_msg(frame)
+
+    print(f"frames: {len(frames)}, bytes: {sum(len(f) for f in frames)}, rounds: {rounds}")
+    legacy, total = bench("legacy", legacy_parse_msg, frames, rounds)
+    current, _ = bench("parse_msg", WsApi.parse_msg, frames, rounds)
+    print(f"speed up: {legacy / current:.2f}x")
+
+    msg_filter = DanmakuFilter(cmds=("GUARD_LOTTERY_START", "GUARD_BUY", "DANMU_MSG"), danmu_uids=WATCHED_UIDS)
+    filtered, passed = bench("filtered", lambda m: WsApi.parse_msg(m, msg_filter=msg_filter), frames, rounds)
+    print(f"passed: {passed}/{total} msg, speed up: {legacy / filtered:.2f}x")
+
+    print("\ncodec (generated frames):")
+    for protover in (WsApi.PROTOVER_RAW, WsApi.PROTOVER_ZLIB, WsApi.PROTOVER_BROTLI):
+        codec_frames = gen_frames(protover=protover)
+        print(f"protover {protover}: {sum(len(f) for f in codec_frames)} bytes")
+        bench(f"protover {protover}", WsApi.parse_msg, codec_frames, rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+XNodeRedis benchmark: 旧版每次调用读取配置并新建连接池 vs 进程内共享客户端。
+
+默认连接 REDIS_CONFIG 中的redis，加 --x-node 时使用 /etc/madliar.settings.ini 中的x-node配置。
+
+    python -m benchmark.bench_x_node_redis [count] [--x-node]
+"""
+import sys
+import time
+import asyncio
+import utils.dao as dao
+from config import REDIS_CONFIG
+from utils.dao import RedisCache, XNodeRedis
+
+
+class LegacyXNodeRedis:
+    """ 旧版: 每次进入时生成新的RedisCache，退出时关闭 """
+
+    async def __aenter__(self) -> RedisCache:
+        self._x_node_redis = await dao.gen_x_node_redis()
+        return self._x_node_redis
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._x_node_redis.close()
+
+
+async def bench(name, context_class, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        async with context_class() as redis:
+            await redis.execute("PING")
+    cost = time.perf_counter() - start
+    print(f"{name:<8} {count} calls: {cost / count * 1000:8.3f} ms/call")
+
+
+async def main():
+    count = 200
+    for arg in sys.argv[1:]:
+        if arg.isdigit():
+            count = int(arg)
+    if "--x-node" not in sys.argv:
+        async def gen_local_redis():
+            return RedisCache(**REDIS_CONFIG)
+        dao.gen_x_node_redis = gen_local_redis
+
+    await bench("legacy", LegacyXNodeRedis, count)
+    await bench("shared", XNodeRedis, count)
+    await XNodeRedis.close()
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
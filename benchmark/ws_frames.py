@@ -0,0 +1,158 @@
+"""
+录制/生成ws帧，供benchmark使用。
+
+帧文件格式: 每帧前加4字节大端长度，依次拼接。
+
+    python -m benchmark.ws_frames record <room_id> <out_file> [count] [protover]
+"""
+import sys
+import json
+import zlib
+import struct
+import asyncio
+import aiohttp
+import brotli
+from random import randint
+
+FRAME_LENGTH = struct.Struct("!I")
+# 生成的DANMU_MSG中有一部分来自这些uid，用于测试DanmakuFilter的uid过滤
+WATCHED_UIDS = (64782616, 9859414)
+
+
+def pack_packet(body: bytes, ver: int = 0, opt: int = 5) -> bytes:
+    return struct.pack("!I2H2I", len(body) + 16, 16, ver, opt, 1) + body
+
+
+def gen_danmaku(i: int) -> dict:
+    return {
+        "cmd": "DANMU_MSG",
+        "info": [
+            [0, 1, 25, 16777215, 1580000000000 + i, 0, 0, "abcdef", 0, 0, 0],
+            f"弹幕内容 {i}",
+            [WATCHED_UIDS[i % 2] if i % 7 == 0 else randint(1, 400000000), f"user_{i}", 0, 0, 0, 10000, 1, ""],
+            [10, "勋章", "主播", 1000 + i, 6067854, "", 0],
+            [20, 0, 6406234, ">50000"],
+            ["", ""], 0, 0, None, {"ts": 1580000000, "ct": "AABBCCDD"}, 0, 0, None, None, 0,
+        ],
+    }
+
+
+def gen_gift(i: int) -> dict:
+    return {
+        "cmd": "SEND_GIFT",
+        "data": {
+            "giftName": "辣条", "num": 1, "uname": f"user_{i}", "uid": 100 + i,
+            "giftId": 1, "price": 100, "coin_type": "silver", "total_coin": 100,
+        },
+    }
+
+
+def gen_guard_buy(i: int) -> dict:
+    return {
+        "cmd": "GUARD_BUY",
+        "data": {
+            "uid": 100 + i, "username": f"user_{i}", "guard_level": 3, "num": 1, "price": 198000,
+            "gift_id": 10003, "gift_name": "舰长", "start_time": 1580000000, "end_time": 1580000000,
+        },
+    }
+
+
+def gen_mixed(i: int) -> dict:
+    """ 默认的帧内容: 以DANMU_MSG为主，混有SEND_GIFT和GUARD_BUY """
+    if i % 10 == 0:
+        return gen_guard_buy(i)
+    elif i % 3 == 0:
+        return gen_gift(i)
+    return gen_danmaku(i)
+
+
+def gen_lottery(i: int) -> dict:
+    """ 依次生成各类抽奖相关的弹幕 """
+    raffle_id = 1000000 + i
+    user = {"uid": 100 + i, "uname": f"user_{i}", "face": "http://i0.hdslb.com/bfs/face/member/noface.jpg"}
+    kind = i % 6
+    if kind == 0:
+        return {"cmd": "GUARD_LOTTERY_START", "data": {"lottery": {
+            "id": raffle_id, "privilege_type": 3, "time": 1200, "sender": user,
+        }}}
+    elif kind == 1:
+        return {"cmd": "SPECIAL_GIFT", "data": {"39": {"id": raffle_id * 1000000, "action": "start"}}}
+    elif kind == 2:
+        return {"cmd": "PK_LOTTERY_START", "data": {"id": raffle_id, "time": 60}}
+    elif kind == 3:
+        return {"cmd": "ANCHOR_LOT_START", "data": {
+            "id": raffle_id, "room_id": 1016, "award_name": "辣条", "award_num": 1, "cur_gift_num": 0,
+            "gift_name": "", "gift_num": 1, "gift_price": 0, "join_type": 0, "require_type": 1,
+            "require_value": 0, "require_text": "关注主播", "danmu": "天选", "time": 600,
+        }}
+    elif kind == 4:
+        return {"cmd": "RAFFLE_START", "data": {
+            "raffleId": raffle_id, "type": "GIFT_30035", "time": 60, "time_wait": 30, "max_time": 90,
+            "thank_text": f"感谢user_{i} 赠送的任意门", "from_user": user,
+        }}
+    return {"cmd": "RAFFLE_END", "data": {
+        "raffleId": raffle_id, "type": "GIFT_30035", "uname": f"user_{i}", "from": user["uname"],
+        "fromFace": user["face"], "giftName": "辣条", "win": {"face": user["face"], "giftNum": 10, "msg": ""},
+    }}
+
+
+def gen_frame(count: int, protover: int = 2, gen=None) -> bytes:
+    packets = b"".join(
+        pack_packet(json.dumps(
+            (gen or gen_mixed)(i),
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode())
+        for i in range(count)
+    )
+    if protover == 3:
+        return pack_packet(brotli.compress(packets), ver=3)
+    elif protover == 2:
+        return pack_packet(zlib.compress(packets), ver=2)
+    return packets
+
+
+def gen_frames(batch_sizes=(1, 10, 50, 200, 1000), protover: int = 2) -> list:
+    return [gen_frame(n, protover=protover) for n in batch_sizes]
+
+
+def load_frames(file_name: str) -> list:
+    with open(file_name, "rb") as f:
+        content = f.read()
+
+    frames = []
+    offset = 0
+    while offset < len(content):
+        length, = FRAME_LENGTH.unpack_from(content, offset)
+        offset += FRAME_LENGTH.size
+        frames.append(content[offset:offset + length])
+        offset += length
+    return frames
+
+
+async def record(room_id: int, file_name: str, count: int = 1000, protover: int = 2):
+    from utils.biliapi import WsApi
+
+    saved = 0
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(url=WsApi.BILI_WS_URI) as ws:
+            await ws.send_bytes(WsApi.gen_join_room_pkg(room_id=room_id, protover=protover))
+            with open(file_name, "wb") as f:
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.BINARY:
+                        break
+                    f.write(FRAME_LENGTH.pack(len(msg.data)) + msg.data)
+                    saved += 1
+                    if saved >= count:
+                        break
+    print(f"{saved} frames saved to {file_name}.")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != "record":
+        print(__doc__)
+        sys.exit(1)
+
+    _count = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+    _protover = int(sys.argv[5]) if len(sys.argv) > 5 else 2
+    asyncio.get_event_loop().run_until_complete(record(int(sys.argv[2]), sys.argv[3], _count, _protover))
@@ -19,8 +19,13 @@ REDIS_CONFIG = {
     "port": int(config["redis"]["port"]),
     "password": config["redis"]["password"],
     "db": int(config["redis"]["stormgift_db"]),
+    "minsize": config["redis"].getint("pool_minsize", fallback=1),
+    "maxsize": config["redis"].getint("pool_maxsize", fallback=10),
 }
 
+# 按key前缀指定redis中值的编码，如 "GIFT_TYPE_:json, LT_GUARD_INTERVAL_:msgpack"
+REDIS_CODECS = config["redis"].get("codecs", fallback="")
+
 REDIS_CONFIG_FOR_GO = {
     "host": config["redis"]["host"],
     "port": int(config["redis"]["port"]),
@@ -4,6 +4,7 @@ import asyncio
 from utils.biliapi import BiliApi
 from utils.dao import redis_cache
 from utils.udp import mq_source_to_raffle
+from db.tables import DMKSource
 from config.log4 import crontab_task_logger as logging
 
 
@@ -17,7 +18,7 @@ async def proc_one_room(room_id):
     ts = int(time.time())
     for guard in guards:
         msg = {"data": {"lottery": guard}}
-        mq_source_to_raffle.put_nowait(("G", room_id, msg, ts))
+        mq_source_to_raffle.put_nowait(DMKSource(prize_type="G", room_id=room_id, danmaku=msg, ts=ts))
     logging.info(f"{room_id} -> guards: {len(guards)}")
 
 
@@ -35,15 +36,14 @@ async def main():
         logging.error(F"Cannot get guard list: {data}")
         return
 
-    new_rooms = []
-    for room_id, characteristic in data.items():
-        key = f"LT_GUARD_INTERVAL_{room_id}"
-        cached_characteristic = await redis_cache.get(key=key)
-        if cached_characteristic == characteristic:
-            continue
-
-        new_rooms.append(room_id)
-        await redis_cache.set(key=key, value=characteristic, timeout=3600*24)
+    room_ids = list(data.keys())
+    async with redis_cache.pipeline():
+        cached = await asyncio.gather(*[redis_cache.get(key=f"LT_GUARD_INTERVAL_{room_id}") for room_id in room_ids])
+        new_rooms = [room_id for room_id, c in zip(room_ids, cached) if c != data[room_id]]
+        await asyncio.gather(*[
+            redis_cache.set(key=f"LT_GUARD_INTERVAL_{room_id}", value=data[room_id], timeout=3600*24)
+            for room_id in new_rooms
+        ])
 
     if len(new_rooms) < 15:
         display_rooms = ", ".join(map(str, new_rooms))
@@ -0,0 +1,18 @@
+"""
+一次性迁移: 把旧版 LT_GUARD_<id> / LT_RAFFLE_<id> / LT_ANCHOR_<id> 字符串key迁入 RedisIndexedStore 的hash和索引。
+
+部署新版本后执行一次，可重复执行。
+"""
+import asyncio
+from utils.dao import redis_cache, RedisGuard, RedisRaffle, RedisAnchor
+from config.log4 import crontab_task_logger as logging
+
+
+async def main():
+    for store in (RedisGuard, RedisRaffle, RedisAnchor):
+        count = await store.migrate_legacy(redis_cache)
+        logging.info(f"{store.__name__} legacy keys migrated: {count}")
+
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(main())
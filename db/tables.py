@@ -10,8 +10,17 @@ class DMKSource(RWSchema):
 
     # T: tv
     # Z: 总督
-    prize_type: str = Field(..., regex="^(T|Z)$")
+    # G: 舰长抽奖
+    # S: 节奏风暴
+    # P: pk抽奖
+    # R: 抽奖结果
+    # A: 天选时刻
+    # D: 弹幕
+    # RAFFLE_START: 小电视等抽奖开始
+    prize_type: str = Field(..., regex="^(T|Z|G|S|P|R|A|D|RAFFLE_START)$")
     room_id: int
+    danmaku: Optional[dict]  # 原始弹幕
+    ts: Optional[int]        # 收到弹幕的时间
 
 
 class RaffleBroadCast(RWSchema):
@@ -27,6 +36,11 @@ class RaffleBroadCast(RWSchema):
     gift_type: Optional[str]  # gift_type
     time_wait: Optional[int]  # info["time_wait"]
     max_time:  Optional[int]  # info["max_time"]
+    # 天选时刻
+    join_type: Optional[int]  # data["join_type"]
+    require: Optional[str]    # f"{require_type}-{require_value}:{require_text}"
+    gift: Optional[str]       # f"{gift_num}*{gift_name}({gift_price})"
+    award: Optional[str]      # f"{award_num}*{award_name}"
 
     def __str__(self):
         return f"<RfBrCst {self.raffle_type}-{self.real_room_id}.{self.raffle_id}>"
@@ -40,3 +54,11 @@ class RaffleBroadCast(RWSchema):
             member_pairs=[(self, time.time())]
         )
         logging.info(f"RaffleBroadCast saved! {self} -> {result}")
+
+    @classmethod
+    async def save_many(cls, redis, broadcasts):
+        if not broadcasts:
+            return
+        now = time.time()
+        result = await redis.zset_zadd(key=cls.__key__, member_pairs=[(bc, now) for bc in broadcasts])
+        logging.info(f"RaffleBroadCast saved! {broadcasts} -> {result}")
@@ -1,200 +1,516 @@
 import sys
+import ssl
 import time
 import asyncio
 import aiohttp
 import traceback
 from random import randint
-from utils.biliapi import WsApi
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from utils.biliapi import WsApi, DanmakuFilter
 from utils.udp import mq_source_to_raffle
+from db.tables import DMKSource
 from config.log4 import lt_server_logger as logging
+from utils import room_array
 from utils.dao import MonitorLiveRooms, InLotteryLiveRooms, ValuableLiveRoom
 from utils.model import objects, MonitorWsClient
 
 
 DEBUG = True
 MONITOR_COUNT = 15000
+WS_SESSION_COUNT = 4
+
+DANMU_MSG_UIDS = (
+    64782616,  # 温柔桢
+    9859414,   # G7
+)
+DANMAKU_FILTER = DanmakuFilter(
+    cmds=(
+        "GUARD_LOTTERY_START",
+        "SPECIAL_GIFT",
+        "PK_LOTTERY_START",
+        "RAFFLE_END",
+        "TV_END",
+        "ANCHOR_LOT_AWARD",
+        "DANMU_MSG",
+        "ANCHOR_LOT_START",
+        "RAFFLE_START",
+    ),
+    danmu_uids=DANMU_MSG_UIDS,
+)
 
 
 if sys.argv[-1].lower() == "--product":
     logging.setLevel("INFO")
     DEBUG = False
 
+# 带宽与CPU二选一: 默认brotli省带宽，--prefer-cpu 时使用zlib
+WS_CODEC_PREFER = "cpu" if "--prefer-cpu" in sys.argv else "bandwidth"
+
+DANMAKU_Q_MAXSIZE = 50000
+DANMAKU_Q_POLICY = "drop_oldest"
+# 解析阶段每次最多从队列取出的帧数；--decode-procs=N 时解压与json解析放到N个子进程中
+DANMAKU_BATCH_SIZE = 500
+DANMAKU_DECODE_CHUNK = 50
+DANMAKU_DECODE_PROCESSES = 0
+for _arg in sys.argv:
+    if _arg.startswith("--q-policy="):
+        DANMAKU_Q_POLICY = _arg.split("=", 1)[1]
+    elif _arg.startswith("--decode-procs="):
+        DANMAKU_DECODE_PROCESSES = int(_arg.split("=", 1)[1])
+
+
+class DanmakuQueue:
+    """
+    有界的弹幕帧队列，解析跟不上时按策略丢弃，内存不再无限增长。
+
+    policy:
+        drop_oldest: 满时丢弃最早的帧。
+        drop_low_priority: 满时优先丢弃非重点房间的帧，重点房间的帧优先出队。
+        batch_drain: 满时一次丢弃最早的一半，让解析直接追上最新的帧。
+    """
+    DROP_OLDEST = "drop_oldest"
+    DROP_LOW_PRIORITY = "drop_low_priority"
+    BATCH_DRAIN = "batch_drain"
+
+    def __init__(self, maxsize=DANMAKU_Q_MAXSIZE, policy=DANMAKU_Q_POLICY):
+        if policy not in (self.DROP_OLDEST, self.DROP_LOW_PRIORITY, self.BATCH_DRAIN):
+            raise ValueError(f"Unknown danmaku queue policy: {policy}")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.high_priority_rooms = set()
+
+        self._high = deque()
+        self._low = deque()
+        self._not_empty = asyncio.Event()
+
+        self._dropped = 0
+        self._max_depth = 0
+        self._lag_count = 0
+        self._lag_sum = 0.0
+        self._lag_max = 0.0
+
+    def qsize(self) -> int:
+        return len(self._high) + len(self._low)
+
+    def _drop(self):
+        if self.policy == self.BATCH_DRAIN:
+            count = max(1, self.maxsize // 2)
+            for _ in range(count):
+                if self._low:
+                    self._low.popleft()
+                elif self._high:
+                    self._high.popleft()
+                else:
+                    break
+                self._dropped += 1
+        else:
+            self._dropped += 1
+            if self._low:
+                self._low.popleft()
+            else:
+                self._high.popleft()
+
+    def put_nowait(self, item):
+        """ item: (ts, room_id, data) """
+        if self.qsize() >= self.maxsize:
+            self._drop()
+
+        if self.policy == self.DROP_LOW_PRIORITY and item[1] in self.high_priority_rooms:
+            self._high.append((time.monotonic(), item))
+        else:
+            self._low.append((time.monotonic(), item))
+
+        depth = self.qsize()
+        if depth > self._max_depth:
+            self._max_depth = depth
+        self._not_empty.set()
+
+    def _pop(self):
+        enqueue_time, item = self._high.popleft() if self._high else self._low.popleft()
+        lag = time.monotonic() - enqueue_time
+        self._lag_count += 1
+        self._lag_sum += lag
+        if lag > self._lag_max:
+            self._lag_max = lag
+        return item
+
+    async def get(self):
+        while not self._high and not self._low:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return self._pop()
+
+    async def get_batch(self, max_count) -> list:
+        while not self._high and not self._low:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        return [self._pop() for _ in range(min(max_count, self.qsize()))]
+
+    def stats(self) -> dict:
+        """ 返回自上次调用以来的统计，并清零 """
+        r = {
+            "danmaku q depth": self.qsize(),
+            "danmaku q max depth": self._max_depth,
+            "danmaku q dropped": self._dropped,
+            "danmaku q lag avg": self._lag_sum / self._lag_count if self._lag_count else 0,
+            "danmaku q lag max": self._lag_max,
+        }
+        self._dropped = 0
+        self._max_depth = self.qsize()
+        self._lag_count = 0
+        self._lag_sum = 0.0
+        self._lag_max = 0.0
+        return r
+
+
+def decode_frames(frames) -> list:
+    """
+    frames: [(ts, room_id, data), ...]
+    返回 [(ts, room_id, [msg, ...]), ...]，只包含DANMAKU_FILTER接受的消息。
+
+    可以在ProcessPoolExecutor的子进程中执行。
+    """
+    result = []
+    for ts, room_id, data in frames:
+        try:
+            msgs = WsApi.parse_msg(data, msg_filter=DANMAKU_FILTER)
+        except Exception as e:
+            logging.error(f"Error Happened in decode danmaku: {e}, room_id: {room_id}\n{traceback.format_exc()}")
+            continue
+        if msgs:
+            result.append((ts, room_id, msgs))
+    return result
 
-async def danmaku_parser_process(damaku_q):
+
+async def danmaku_parser_process(damaku_q, decode_executor=None, batch_size=DANMAKU_BATCH_SIZE):
+    """
+    批量取出弹幕帧并分发。decode_executor不为空时，解压与json解析在进程池中完成。
+    """
+    loop = asyncio.get_event_loop()
 
     def parse(ts, room_id, msg):
         cmd = msg["cmd"]
         if cmd == "GUARD_LOTTERY_START":
-            mq_source_to_raffle.put_nowait(("G", room_id, msg, ts))
+            mq_source_to_raffle.put_nowait(DMKSource(prize_type="G", room_id=room_id, danmaku=msg, ts=ts))
             logging.info(f"SOURCE: {cmd}, room_id: {room_id}")
 
         elif cmd == "SPECIAL_GIFT":
-            mq_source_to_raffle.put_nowait(("S", room_id, msg, ts))
+            mq_source_to_raffle.put_nowait(DMKSource(prize_type="S", room_id=room_id, danmaku=msg, ts=ts))
             logging.info(f"SOURCE: {cmd}-节奏风暴, room_id: {room_id}")
 
         elif cmd == "PK_LOTTERY_START":
-            mq_source_to_raffle.put_nowait(("P", room_id, msg, ts))
+            mq_source_to_raffle.put_nowait(DMKSource(prize_type="P", room_id=room_id, danmaku=msg, ts=ts))
             logging.info(f"SOURCE: {cmd}, room_id: {room_id}")
 
         elif cmd in ("RAFFLE_END", "TV_END", "ANCHOR_LOT_AWARD"):
-            mq_source_to_raffle.put_nowait(("R", room_id, msg, ts))
+            mq_source_to_raffle.put_nowait(DMKSource(prize_type="R", room_id=room_id, danmaku=msg, ts=ts))
             display_msg = msg.get("data", {}).get("win", {}).get("msg", "")
             logging.info(f"SOURCE: {cmd}, room_id: {room_id}, msg: {display_msg}")
 
         elif cmd.startswith("DANMU_MSG"):
-            if msg["info"][2][0] in (
-                64782616,  # 温柔桢
-                9859414,   # G7
-            ):
-                mq_source_to_raffle.put_nowait(("D", room_id, msg, ts))
+            if msg["info"][2][0] in DANMU_MSG_UIDS:
+                mq_source_to_raffle.put_nowait(DMKSource(prize_type="D", room_id=room_id, danmaku=msg, ts=ts))
                 logging.info(f"DANMU_MSG: put to mq, room_id: {room_id}, msg: {msg}")
 
         elif cmd == "ANCHOR_LOT_START":
-            mq_source_to_raffle.put_nowait(("A", room_id, msg, ts))
+            mq_source_to_raffle.put_nowait(DMKSource(prize_type="A", room_id=room_id, danmaku=msg, ts=ts))
             data = msg["data"]
             logging.info(f"SOURCE: {cmd}, room_id: {room_id}, {data['require_text']} -> {data['award_name']}")
 
         elif cmd == "RAFFLE_START":
             data = msg["data"]
-            mq_source_to_raffle.put_nowait(("RAFFLE_START", room_id, msg, ts))
+            mq_source_to_raffle.put_nowait(DMKSource(prize_type="RAFFLE_START", room_id=room_id, danmaku=msg, ts=ts))
             logging.info(f"SOURCE: {cmd}, room_id: {room_id}, {data['thank_text']}")
 
     while True:
-        start_time, msg_from_room_id, danmaku = await damaku_q.get()
-        for m in WsApi.parse_msg(danmaku):
-            try:
-                parse(start_time, msg_from_room_id, m)
-            except KeyError:
-                continue
-            except Exception as e:
-                logging.error(f"Error Happened in parse danmaku: {e}\n{traceback.format_exc()}")
-                continue
+        frames = await damaku_q.get_batch(batch_size)
+        if decode_executor is None:
+            decoded = decode_frames(frames)
+        else:
+            chunks = await asyncio.gather(*[
+                loop.run_in_executor(decode_executor, decode_frames, frames[i:i + DANMAKU_DECODE_CHUNK])
+                for i in range(0, len(frames), DANMAKU_DECODE_CHUNK)
+            ])
+            decoded = [r for chunk in chunks for r in chunk]
+
+        for start_time, msg_from_room_id, msgs in decoded:
+            for m in msgs:
+                try:
+                    parse(start_time, msg_from_room_id, m)
+                except KeyError:
+                    continue
+                except Exception as e:
+                    logging.error(f"Error Happened in parse danmaku: {e}\n{traceback.format_exc()}")
+                    continue
+
+
+class TimerWheel:
+    """
+    所有连接共用一个时间轮，心跳与重连退避都挂在轮上，由一个协程按tick推进，
+    不再为每个房间创建心跳Task与sleep计时器。
+    """
+    __slots__ = ("tick", "_slots", "_cursor")
+
+    def __init__(self, slot_count=128, tick=1.0):
+        self.tick = tick
+        self._slots = [[] for _ in range(slot_count)]
+        self._cursor = 0
+
+    def schedule(self, delay, item):
+        ticks = max(1, int(round(delay / self.tick)))
+        rounds, offset = divmod(ticks, len(self._slots))
+        if offset == 0:
+            rounds, offset = rounds - 1, len(self._slots)
+        self._slots[(self._cursor + offset) % len(self._slots)].append((rounds, item))
+
+    def advance(self) -> list:
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        slot = self._slots[self._cursor]
+        if not slot:
+            return []
+
+        due = []
+        pending = []
+        for rounds, item in slot:
+            if rounds <= 0:
+                due.append(item)
+            else:
+                pending.append((rounds - 1, item))
+        self._slots[self._cursor] = pending
+        return due
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+
+HEART_BEAT_INTERVAL = 50
+HEART_BEAT_PKG = WsApi.gen_heart_beat_pkg()
+RECONNECT_BACKOFF = (1, 3, 5, 7, 10, 15, 30, 60, 80)
+
+TIMER_HEARTBEAT = 0
+TIMER_RECONNECT = 1
 
 
 class WsClient:
-    def __init__(self, room_id, on_message, on_broken):
+    """
+    单个房间的连接状态。
+
+    每个连接只保留一个读取Task；心跳与断线重连由ClientsManager的时间轮调度，
+    过期的定时项通过generation识别后丢弃。
+    """
+    __slots__ = (
+        "room_id", "session", "protover", "ws_conn", "task", "closed", "generation",
+        "_mux", "_join_pkg", "_connect_times", "_reconnect_time",
+    )
+
+    def __init__(self, room_id, mux, session, protover=WsApi.PROTOVER_ZLIB):
         self.room_id = room_id
-        self.on_message = on_message
-        self.on_broken = on_broken
+        self.protover = protover
 
-        self.session = None
+        # session由ClientsManager共享，WsClient不负责关闭
+        self.session = session
+        self.ws_conn = None
         self.task = None
-        self.task_heartbeat = None
-        self._url = WsApi.BILI_WS_URI
-        self._join_pkg = WsApi.gen_join_room_pkg(room_id=self.room_id)
-        self._hb_pkg = WsApi.gen_heart_beat_pkg()
+        self.closed = False
+        self.generation = 0
 
+        self._mux = mux
+        self._join_pkg = WsApi.gen_join_room_pkg(room_id=self.room_id, protover=protover)
         self._connect_times = 0
         self._reconnect_time = 0
 
+    @property
+    def active(self) -> bool:
+        return self.task is not None and not self.task.done()
+
     async def _listen(self):
-        self.session = session = aiohttp.ClientSession()
-        ws_conn = await session.ws_connect(url=self._url)
+        self.ws_conn = ws_conn = await self.session.ws_connect(url=WsApi.BILI_WS_URI)
         await ws_conn.send_bytes(self._join_pkg)
 
         self._connect_times += 1
         self._reconnect_time = 0
-
-        async def heart_beat():
-            while True:
-                await asyncio.sleep(50)
-                if not ws_conn.closed:
-                    await ws_conn.send_bytes(self._hb_pkg)
-
-        if self.task_heartbeat is not None:
-            raise RuntimeError(f"self.task_heartbeat task not stopped! It will caused MEMORY_LEAK!")
-        self.task_heartbeat = asyncio.create_task(heart_beat())
+        self._mux.schedule(HEART_BEAT_INTERVAL, self, TIMER_HEARTBEAT)
 
         while True:
             msg = await ws_conn.receive()
             if msg.type == aiohttp.WSMsgType.ERROR:
-                closed_reason = f"ERROR: {msg.data}"
-                break
-            elif msg.type == aiohttp.WSMsgType.CLOSED:
-                closed_reason = f"CLOSED_BY_REMOTE"
-                break
+                return f"ERROR: {msg.data}"
+            elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING):
+                return f"CLOSED_BY_REMOTE"
             else:
-                await self.on_message(msg.data, self)
+                self._mux.on_message(msg.data, self)
 
-        return closed_reason
+    async def _listen_once(self):
+        try:
+            closed_reason = await self._listen()
+        except asyncio.CancelledError:
+            closed_reason = "KILL"
+        except Exception as e:
+            logging.warning(f"WS._listen raised a Exception! {e}")
+            closed_reason = F"EXCEPTION: {e}"
 
-    async def _listen_for_ever(self):
-        while True:
-            try:
-                closed_reason = await self._listen()
-            except asyncio.CancelledError:
-                closed_reason = "KILL"
-            except Exception as e:
-                logging.warning(f"WS._listen raised a Exception! {e}")
-                closed_reason = F"EXCEPTION: {e}"
-
-            if self.session and not self.session.closed:
-                await self.session.close()
-                self.session = None
-
-            if self.task_heartbeat:
-                if self.task_heartbeat.done():
-                    raise RuntimeError("self.task_heartbeat Should not be done!")
-                self.task_heartbeat.cancel()
-                self.task_heartbeat = None
-
-            if closed_reason == "KILL":
-                return
-
-            await self.on_broken(closed_reason, self)
-            logging.debug(F"_listen BROKEN: {self.room_id}, reason: {closed_reason}")
-
-            self._reconnect_time += 1
-            if self._reconnect_time < 2:
-                sleep_time = 1
-            elif self._reconnect_time < 3:
-                sleep_time = 3
-            elif self._reconnect_time < 4:
-                sleep_time = 5
-            elif self._reconnect_time < 5:
-                sleep_time = 7
-            elif self._reconnect_time < 6:
-                sleep_time = 10
-            elif self._reconnect_time < 7:
-                sleep_time = 15
-            elif self._reconnect_time < 8:
-                sleep_time = 30
-            elif self._reconnect_time < 9:
-                sleep_time = 60
-            else:
-                sleep_time = 80
-            await asyncio.sleep(sleep_time + randint(0, 5000) / 1000)
+        if self.ws_conn is not None:
+            if not self.ws_conn.closed:
+                await self.ws_conn.close()
+            self.ws_conn = None
 
-    async def connect(self):
-        if self.task is not None:
-            if self.task.done():
-                logging.error(f"Task shutdown! {self.room_id} -> {self.task}")
-                raise RuntimeError("Monitor Task shutdown!")
-            else:
-                logging.warning(f"Task ALREADY Created! {self.task}")
-                return
+        if closed_reason == "KILL" or self.closed:
+            return
 
-        self.task = asyncio.create_task(self._listen_for_ever())
+        self._mux.on_broken(closed_reason, self)
+        logging.debug(F"_listen BROKEN: {self.room_id}, reason: {closed_reason}")
 
-    async def close(self):
-        if self.task is None:
-            logging.warning(f"Monitor Task pending! {self.room_id}")
+        sleep_time = RECONNECT_BACKOFF[min(self._reconnect_time, len(RECONNECT_BACKOFF) - 1)]
+        self._reconnect_time += 1
+        self._mux.schedule(sleep_time + randint(0, 5000) / 1000, self, TIMER_RECONNECT)
+
+    def _start(self):
+        self.generation += 1
+        self.task = asyncio.create_task(self._listen_once())
+
+    async def on_timer(self, kind, generation):
+        if self.closed or generation != self.generation:
+            return
+
+        if kind == TIMER_HEARTBEAT:
+            if self.ws_conn is not None and not self.ws_conn.closed:
+                await self.ws_conn.send_bytes(HEART_BEAT_PKG)
+                self._mux.schedule(HEART_BEAT_INTERVAL, self, TIMER_HEARTBEAT)
+
+        elif kind == TIMER_RECONNECT:
+            self._start()
+
+    async def connect(self):
+        if self.task is not None:
+            logging.warning(f"Task ALREADY Created! {self.task}")
             return
+        self._start()
 
-        if self.task.done():
+    async def close(self):
+        if self.closed:
             logging.error(f"Task ALREADY closed! {self.room_id} -> {self.task}")
             raise RuntimeError("Task ALREADY closed!")
 
-        self.task.cancel()
+        self.closed = True
+        self.generation += 1
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
         self.task = None
 
 
+async def get_expected_rooms():
+    """ 返回的expected为有序数组，见 utils.room_array """
+    in_lottery = await InLotteryLiveRooms.get_all()
+    expected = room_array.union(room_array.to_sorted(in_lottery), await MonitorLiveRooms.get_array())
+    valuable = await ValuableLiveRoom.get_all()
+
+    # 按价值顺序补充房间，直到达到MONITOR_COUNT
+    valuable_hit_count = 0
+    remaining = MONITOR_COUNT - len(expected)
+    if remaining > 0:
+        picked = []
+        for room_id, hit in zip(valuable, room_array.isin(valuable, expected)):
+            if hit:
+                valuable_hit_count += 1
+                continue
+            picked.append(room_id)
+            if len(picked) >= remaining:
+                break
+        expected = room_array.union(expected, room_array.to_sorted(picked))
+
+    cache_hit_rate = valuable_hit_count / len(valuable) * 100 if valuable else 0
+    return expected, in_lottery, valuable, cache_hit_rate
+
+
 class ClientsManager:
-    def __init__(self, q):
+    def __init__(self, q, prefer="bandwidth", reporter=MonitorWsClient.record):
         self._all_clients = set()
         self._message_q = q
+        self._reporter = reporter
+        self._protover = WsApi.choose_protover(prefer)
         self._message_count = 0
         self._broken_clients = asyncio.Queue()
+        self._sessions = []
+        self._wheel = TimerWheel()
+
+    def on_message(self, data, ws):
+        self._message_count += 1
+        self._message_q.put_nowait((int(time.time()), ws.room_id, data))
+
+    def on_broken(self, reason, ws):
+        self._broken_clients.put_nowait(f"{ws.room_id}${reason}")
+
+    def schedule(self, delay, ws, kind):
+        self._wheel.schedule(delay, (ws, kind, ws.generation))
+
+    async def drive_timer_wheel(self):
+        tick = self._wheel.tick
+        next_tick = time.monotonic() + tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - time.monotonic()))
+            next_tick += tick
+            for ws, kind, generation in self._wheel.advance():
+                try:
+                    await ws.on_timer(kind, generation)
+                except Exception as e:
+                    logging.warning(f"WS timer error: {ws.room_id}, kind: {kind}, e: {e}")
+
+    def _get_session(self, room_id) -> aiohttp.ClientSession:
+        """
+        所有WsClient共用少量session，DNS缓存、连接器与SSL context不再按房间重复创建。
+        """
+        if not self._sessions:
+            ssl_context = ssl.create_default_context()
+            for _ in range(WS_SESSION_COUNT):
+                connector = aiohttp.TCPConnector(
+                    limit=MONITOR_COUNT // WS_SESSION_COUNT + 1000,
+                    limit_per_host=0,
+                    use_dns_cache=True,
+                    ttl_dns_cache=600,
+                    ssl=ssl_context,
+                )
+                self._sessions.append(aiohttp.ClientSession(connector=connector))
+        return self._sessions[room_id % len(self._sessions)]
+
+    async def close_sessions(self):
+        for session in self._sessions:
+            if not session.closed:
+                await session.close()
+        self._sessions = []
+
+    async def apply_rooms(self, expected, high_priority: set = None):
+        expected = room_array.to_sorted(expected)
+        if high_priority is not None and isinstance(self._message_q, DanmakuQueue):
+            self._message_q.high_priority_rooms = set(
+                room_array.intersection(room_array.to_sorted(high_priority), expected)
+            )
+
+        existed = room_array.to_sorted(ws.room_id for ws in self._all_clients)
+        need_add = room_array.difference(expected, existed)
+        need_del = set(room_array.difference(existed, expected))
+
+        need_del_clients = {ws for ws in self._all_clients if ws.room_id in need_del}
+        logging.info(f"WS MONITOR CLIENTS UPDATING: close non-active clients, count: {len(need_del_clients)}")
+        for ws in need_del_clients:
+            await ws.close()
+            self._all_clients.remove(ws)
+
+        logging.info(f"WS MONITOR CLIENTS CREATING NEW: {len(need_add)}")
+        for i, room_id in enumerate(need_add):
+            if i > 0 and i % 300 == 0:
+                await asyncio.sleep(3)
+
+            ws = WsClient(
+                room_id=room_id,
+                mux=self,
+                session=self._get_session(room_id),
+                protover=self._protover,
+            )
+            await ws.connect()
+            self._all_clients.add(ws)
+        return need_add, need_del
 
     async def update_connection(self):
 
@@ -202,49 +518,9 @@ class ClientsManager:
             start_time = time.time()
             logging.info(f"WS MONITOR CLIENTS UPDATING...start: {start_time}.")
 
-            in_lottery = await InLotteryLiveRooms.get_all()
-            expected = in_lottery | (await MonitorLiveRooms.get())
-            valuable = await ValuableLiveRoom.get_all()
-            valuable_hit_count = 0
-            for room_id in valuable:
-                expected_len = len(expected)
-                if expected_len >= MONITOR_COUNT:
-                    break
-                expected.add(room_id)
-                if len(expected) == expected_len:
-                    valuable_hit_count += 1
-            cache_hit_rate = valuable_hit_count / len(valuable) * 100
-
-            existed = {ws.room_id for ws in self._all_clients}
-            need_add = expected - existed
-            need_del = existed - expected
-
-            need_del_clients = {ws for ws in self._all_clients if ws.room_id in need_del}
-            logging.info(f"WS MONITOR CLIENTS UPDATING: close non-active clients, count: {len(need_del_clients)}")
-            for ws in need_del_clients:
-                await ws.close()
-                self._all_clients.remove(ws)
-
-            logging.info(f"WS MONITOR CLIENTS CREATING NEW: {len(need_add)}")
-            for i, room_id in enumerate(need_add):
-                if i > 0 and i % 300 == 0:
-                    await asyncio.sleep(3)
-
-                async def on_broken(reason, ws):
-                    self._broken_clients.put_nowait(f"{ws.room_id}${reason}")
-
-                async def on_message(data, ws):
-                    self._message_count += 1
-                    m = (int(time.time()), ws.room_id, data)
-                    self._message_q.put_nowait(m)
-
-                ws = WsClient(
-                    room_id=room_id,
-                    on_message=on_message,
-                    on_broken=on_broken,
-                )
-                await ws.connect()
-                self._all_clients.add(ws)
+            expected, in_lottery, valuable, cache_hit_rate = await get_expected_rooms()
+            need_add, need_del = await self.apply_rooms(expected, high_priority=in_lottery | set(valuable))
+
             logging.info(f"WS MONITOR CLIENTS UPDATING: MonitorWsClient.")
             # record
             __monitor_info = {
@@ -252,7 +528,7 @@ class ClientsManager:
                 "target clients": len(expected),
                 "valuable hit rate": cache_hit_rate,
             }
-            await MonitorWsClient.record(__monitor_info)
+            await self._reporter(__monitor_info)
 
             logging.info(
                 f"WS MONITOR CLIENTS UPDATE! cost: {time.time() - start_time:.3f}."
@@ -285,7 +561,7 @@ class ClientsManager:
                 monitor_rooms = set()
                 for i, ws in enumerate(self._all_clients):
                     monitor_rooms.add(ws.room_id)
-                    if ws.task and not ws.task.done():
+                    if ws.active:
                         active_clients += 1
                     else:
                         logging.debug(
@@ -316,7 +592,11 @@ class ClientsManager:
                     "active clients": active_clients,
                     "total clients": len(self._all_clients)
                 }
-                await MonitorWsClient.record(__monitor_info)
+                if isinstance(self._message_q, DanmakuQueue):
+                    q_stats = self._message_q.stats()
+                    __monitor_info.update(q_stats)
+                    logging.info(f"Danmaku queue: {q_stats}")
+                await self._reporter(__monitor_info)
                 self._message_count = 0
                 msg_speed_peak = 0
 
@@ -329,18 +609,24 @@ class ClientsManager:
             await asyncio.gather(
                 self.update_connection(),
                 self.monitor_status(),
+                self.drive_timer_wheel(),
             )
         except Exception as e:
             logging.error(f"WS MONITOR EXIT! Exception: {e}\n\n{traceback.format_exc()}")
+        finally:
+            await self.close_sessions()
 
 
 async def main():
     await objects.connect()
-    danmaku_q = asyncio.Queue()
+    danmaku_q = DanmakuQueue()
+    decode_executor = None
+    if DANMAKU_DECODE_PROCESSES > 0:
+        decode_executor = ProcessPoolExecutor(max_workers=DANMAKU_DECODE_PROCESSES)
 
     await asyncio.gather(
-        danmaku_parser_process(danmaku_q),
-        ClientsManager(danmaku_q).run()
+        danmaku_parser_process(danmaku_q, decode_executor=decode_executor),
+        ClientsManager(danmaku_q, prefer=WS_CODEC_PREFER).run()
     )
     await objects.close()
 
@@ -5,29 +5,49 @@ import datetime
 import traceback
 from config import g
 from utils.cq import async_zy
-from utils.udp import mq_server
+from utils.udp import mq_source_to_raffle
 from utils.biliapi import BiliApi
 from db.tables import DMKSource, RaffleBroadCast
 from config.log4 import lt_server_logger as logging
-from utils.dao import redis_cache, RedisGuard, RedisRaffle, RedisAnchor, InLotteryLiveRooms
-from utils.model import objects, Guard, Raffle
+from utils.dao import redis_cache, RedisGuard, RedisRaffle, RedisAnchor, InLotteryLiveRooms, RaffleDeDup
+from utils.metrics import LatencyRecorder
+from utils.model import objects, Guard, Raffle, MonitorWsClient
 
 
 class Executor:
+    """
+    按prize_type分发到对应的handler，handler签名统一为 (room_id, danmaku)。
+    分发表在类定义后生成，见 Executor.HANDLERS。
+    """
+    HANDLERS = {}
+    timings = {}
+
     def __init__(self, msg: DMKSource):
-        self._start_time = time.time()
+        # 以source收到弹幕的时间为准
+        self._start_time = msg.ts or time.time()
         self.msg = msg
 
-    async def g(self, *args):
-        key_type, room_id, danmaku, *_ = args
+    def broadcast(self, raffle_type, room_id, raffle_id, gift_name, duration, **kw):
+        created_time = datetime.datetime.fromtimestamp(self._start_time)
+        bc = RaffleBroadCast(
+            raffle_type=raffle_type,
+            ts=int(self._start_time),
+            real_room_id=room_id,
+            raffle_id=raffle_id,
+            gift_name=gift_name,
+            created_time=created_time,
+            expire_time=created_time + datetime.timedelta(seconds=duration),
+            **kw
+        )
+        write_behind.add_broadcast(bc)
+
+    async def g(self, room_id, danmaku):
 
         guards = [danmaku["data"]["lottery"]]
         await self._handle_guard(room_id, guards)
 
-    async def r(self, *args):
+    async def r(self, room_id, danmaku):
         """ record_raffle """
-
-        key_type, room_id, danmaku, *_ = args
         cmd = danmaku["cmd"]
 
         if cmd == "ANCHOR_LOT_AWARD":
@@ -78,9 +98,8 @@ class Executor:
             await RedisRaffle.add(raffle_id=raffle_id, value=raffle)
             await Raffle.create(**raffle)
 
-    async def d(self, *args):
+    async def d(self, room_id, danmaku):
         """ danmaku to qq """
-        key_type, room_id, danmaku, *_ = args
         info = danmaku.get("info", {})
         msg = str(info[1])
         if msg in g.lottery_danmaku:
@@ -100,27 +119,18 @@ class Executor:
         logging.info(message)
         await async_zy.send_private_msg(user_id=g.QQ_NUMBER_DD, message=message)
 
-    async def p(self, *args):
+    async def p(self, room_id, danmaku):
         """ pk """
-
-        key_type, room_id, danmaku, *_ = args
         raffle_id = danmaku["data"]["id"]
         key = f"P${room_id}${raffle_id}"
-        if await redis_cache.set_if_not_exists(key, "de-duplication"):
-            await self.broadcast(json.dumps({
-                "raffle_type": "pk",
-                "ts": int(self._start_time),
-                "real_room_id": room_id,
-                "raffle_id": raffle_id,
-                "gift_name": "PK",
-            }, ensure_ascii=False))
+        if await RaffleDeDup.add(key):
+            self.broadcast("pk", room_id, raffle_id, "PK", duration=danmaku["data"].get("time", 60))
 
-    async def s(self, *args):
+    async def s(self, room_id, danmaku):
         """ storm """
-        key_type, room_id, danmaku, *_ = args
         raffle_id = int(danmaku["data"]["39"]["id"])
         key = F"S${room_id}${raffle_id}"
-        if not await redis_cache.set_if_not_exists(key, "de-duplication"):
+        if not await RaffleDeDup.add(key):
             return
 
         created_time = datetime.datetime.fromtimestamp(self._start_time)
@@ -136,25 +146,17 @@ class Executor:
             "created_time": created_time,
             "expire_time": expire_time,
         }
-        await RedisGuard.add(raffle_id=inner_raffle_id, value=create_param)
-        await Guard.create(**create_param)
-
-        await self.broadcast(json.dumps({
-            "raffle_type": "storm",
-            "ts": int(self._start_time),
-            "real_room_id": room_id,
-            "raffle_id": raffle_id,
-            "gift_name": "节奏风暴",
-        }, ensure_ascii=False))
+        write_behind.add_guard(create_param)
 
-    async def a(self, *args):
+        self.broadcast("storm", room_id, raffle_id, "节奏风暴", duration=90)
+
+    async def a(self, room_id, danmaku):
         """
         anchor
 
         require_type = data["require_type"]
         0: 无限制; 1: 关注主播; 2: 粉丝勋章; 3大航海； 4用户等级；5主站等级
         """
-        key_type, room_id, danmaku, *_ = args
         data = danmaku["data"]
         raffle_id = data["id"]
         room_id = data["room_id"]
@@ -171,24 +173,25 @@ class Executor:
         danmu = data["danmu"]
 
         key = f"A${room_id}${raffle_id}"
-        if await redis_cache.set_if_not_exists(key, "de-duplication"):
-            await self.broadcast(json.dumps({
-                "raffle_type": "anchor",
-                "ts": int(self._start_time),
-                "real_room_id": room_id,
-                "raffle_id": raffle_id,
-                "gift_name": "天选时刻",
-                "join_type": join_type,
-                "require": f"{require_type}-{require_value}:{require_text}",
-                "gift": f"{gift_num}*{gift_name or 'null'}({gift_price})",
-                "award": f"{award_num}*{award_name}",
-            }, ensure_ascii=False))
+        if await RaffleDeDup.add(key):
+            require = f"{require_type}-{require_value}:{require_text}"
+            gift = f"{gift_num}*{gift_name or 'null'}({gift_price})"
+            award = f"{award_num}*{award_name}"
+            self.broadcast(
+                "anchor", room_id, raffle_id, "天选时刻", duration=data.get("time", 600),
+                join_type=join_type, require=require, gift=gift, award=award,
+            )
+            logging.info(
+                f"\tAnchor found: room_id: {room_id} $ {raffle_id}, join_type: {join_type}, "
+                f"require: {require}, gift: {gift}, award: {award}, "
+                f"cur_gift_num: {cur_gift_num}, danmu: {danmu}"
+            )
 
     async def _handle_guard(self, room_id, guard_list):
         for info in guard_list:
             raffle_id = info['id']
             key = F"G${room_id}${raffle_id}"
-            if not await redis_cache.set_if_not_exists(key, "de-duplication"):
+            if not await RaffleDeDup.add(key):
                 continue
 
             privilege = info["privilege_type"]
@@ -205,7 +208,7 @@ class Executor:
                 created_time=created_time,
                 expire_time=expire_time,
             )
-            await bc.save(redis_cache)
+            write_behind.add_broadcast(bc)
 
             sender = info["sender"]
             create_param = {
@@ -218,21 +221,19 @@ class Executor:
                 "created_time": created_time,
                 "expire_time": expire_time,
             }
-            await RedisGuard.add(raffle_id=raffle_id, value=create_param)
-            await Guard.create(**create_param)
+            write_behind.add_guard(create_param)
             logging.info(
                 f"\tGuard found: room_id: {room_id} $ {raffle_id} "
                 f"({gift_name}) <- {sender['uname']}"
             )
 
     async def _handle_tv(self, room_id, gift_list):
-        await InLotteryLiveRooms.add(room_id=room_id)
-        gift_type_to_name_map = {}
+        write_behind.add_in_lottery(room_id)
 
         for info in gift_list:
             raffle_id = info["raffleId"]
             key = f"T${room_id}${raffle_id}"
-            if not await redis_cache.set_if_not_exists(key, "de-duplication"):
+            if not await RaffleDeDup.add(key):
                 continue
 
             gift_type = info["type"]
@@ -252,7 +253,7 @@ class Executor:
                 time_wait=info["time_wait"],
                 max_time=info["max_time"],
             )
-            await bc.save(redis_cache)
+            write_behind.add_broadcast(bc)
 
             sender_name = info["from_user"]["uname"]
             sender_face = info["from_user"]["face"]
@@ -272,15 +273,10 @@ class Executor:
                 "created_time": created_time,
                 "expire_time": expire_time
             }
-            await RedisRaffle.add(raffle_id=raffle_id, value=create_param, _pre=True)
-            await Raffle.record_raffle_before_result(**create_param)
-            gift_type_to_name_map[gift_type] = gift_name
-
-        for gift_type, gift_name in gift_type_to_name_map.items():
-            await redis_cache.set(key=f"GIFT_TYPE_{gift_type}", value=gift_name)
+            write_behind.add_raffle(create_param)
+            write_behind.set_gift_type(gift_type, gift_name)
 
-    async def hdl_lottery_or_guard(self):
-        room_id = self.msg.room_id
+    async def hdl_lottery_or_guard(self, room_id, danmaku):
         prize_type = self.msg.prize_type
 
         flag, result = await BiliApi.lottery_check(room_id=room_id)
@@ -296,73 +292,338 @@ class Executor:
         await self._handle_guard(room_id, guards)
         await self._handle_tv(room_id, gifts)
 
-    async def raffle_start(self, *args):
-        key_type, room_id, danmaku, *_ = args
+    async def raffle_start(self, room_id, danmaku):
         data = danmaku["data"]
         await self._handle_tv(room_id=room_id, gift_list=[data])
 
     async def run(self):
-        if self.msg.prize_type in ("T", "Z"):
-            await self.hdl_lottery_or_guard()
-
+        prize_type = self.msg.prize_type
+        handler = self.HANDLERS.get(prize_type)
+        if handler is None:
+            logging.error(f"No handler for prize_type: {prize_type}, room_id: {self.msg.room_id}")
+            return
 
-class RaffleProcessor:
+        start_time = time.monotonic()
+        try:
+            await handler(self, self.msg.room_id, self.msg.danmaku)
+        finally:
+            self.timings[prize_type].since(start_time)
+
+
+Executor.HANDLERS.update({
+    "T": Executor.hdl_lottery_or_guard,
+    "Z": Executor.hdl_lottery_or_guard,
+    "G": Executor.g,
+    "S": Executor.s,
+    "R": Executor.r,
+    "P": Executor.p,
+    "A": Executor.a,
+    "D": Executor.d,
+    "RAFFLE_START": Executor.raffle_start,
+})
+Executor.timings.update({prize_type: LatencyRecorder() for prize_type in Executor.HANDLERS})
+
+
+class RaffleWriteBehind:
+    """
+    guard/tv的持久化缓冲。handler只把数据放入缓冲区，每FLUSH_INTERVAL秒(或缓冲满时)合并写入:
+    redis命令一次往返发出，mysql用insert_many ... ON DUPLICATE KEY UPDATE批量写入。
+    """
+    FLUSH_INTERVAL = 0.2
+    FLUSH_SIZE = 200
 
     def __init__(self):
-        self._dmk_source_q = asyncio.queues.Queue()
-        self._workers = []
+        self._full = asyncio.Event()
+        self._reset()
+
+    def _reset(self):
+        self.broadcasts = []
+        self.guards = []
+        self.raffles = []
+        self.in_lottery_rooms = set()
+        self.gift_types = {}
+
+    def pending(self) -> int:
+        return len(self.broadcasts) + len(self.guards) + len(self.raffles)
+
+    def _added(self):
+        if self.pending() >= self.FLUSH_SIZE:
+            self._full.set()
+
+    def add_broadcast(self, bc: RaffleBroadCast):
+        self.broadcasts.append(bc)
+        self._added()
+
+    def add_guard(self, create_param: dict):
+        self.guards.append(create_param)
+        self._added()
+
+    def add_raffle(self, create_param: dict):
+        self.raffles.append(create_param)
+        self._added()
+
+    def add_in_lottery(self, room_id):
+        self.in_lottery_rooms.add(room_id)
+
+    def set_gift_type(self, gift_type, gift_name):
+        self.gift_types[gift_type] = gift_name
+
+    async def _flush_redis(self, broadcasts, guards, raffles, gift_types):
+        await asyncio.gather(
+            RaffleBroadCast.save_many(redis_cache, broadcasts),
+            RedisGuard.add_many([(p["gift_id"], p) for p in guards]),
+            RedisRaffle.add_many([(p["raffle_id"], p) for p in raffles], _pre=True),
+            *[redis_cache.set(key=f"GIFT_TYPE_{t}", value=name) for t, name in gift_types.items()],
+        )
 
-    async def receive(self):
+    @staticmethod
+    async def _write_mysql(name, write_many, write_one, params_list):
+        """ 批量写入失败时逐条重试，单条记录的错误不影响其他记录 """
+        if not params_list:
+            return
+        try:
+            return await write_many(params_list)
+        except Exception as e:
+            logging.error(f"RAFFLE write behind {name} bulk insert error: {e}, retry {len(params_list)} rows one by one.")
+
+        failed = 0
+        for params in params_list:
+            try:
+                await write_one(**params)
+            except Exception as e:
+                failed += 1
+                logging.error(f"RAFFLE write behind {name} insert error: {e}, params: {params}")
+        logging.info(f"RAFFLE write behind {name} retried: {len(params_list) - failed} saved, {failed} failed.")
+
+    async def _flush_mysql(self, guards, raffles):
+        # guard与raffle相互独立，一方失败不影响另一方
+        await asyncio.gather(
+            self._write_mysql("guard", Guard.create_many, Guard.create, guards),
+            self._write_mysql(
+                "raffle", Raffle.record_raffle_before_result_many, Raffle.record_raffle_before_result, raffles
+            ),
+            return_exceptions=True,
+        )
+
+    async def flush(self):
+        broadcasts, guards, raffles = self.broadcasts, self.guards, self.raffles
+        in_lottery_rooms, gift_types = self.in_lottery_rooms, self.gift_types
+        self._reset()
+        if not (broadcasts or guards or raffles or in_lottery_rooms):
+            return
+
+        start_time = time.monotonic()
+        results = await asyncio.gather(
+            self._flush_redis(broadcasts, guards, raffles, gift_types),
+            self._flush_mysql(guards, raffles),
+            InLotteryLiveRooms.add_many(in_lottery_rooms),
+            return_exceptions=True,
+        )
+
+        for r in results:
+            if isinstance(r, Exception):
+                logging.error(
+                    f"RAFFLE write behind flush error: {r}, broadcasts: {len(broadcasts)}, "
+                    f"guards: {len(guards)}, raffles: {len(raffles)}"
+                )
+        logging.info(
+            f"RAFFLE write behind flushed: broadcasts {len(broadcasts)}, guards {len(guards)}, "
+            f"raffles {len(raffles)}, cost: {time.monotonic() - start_time:.3f}"
+        )
+
+    async def run(self):
         while True:
-            de_dup = set()
-            for index in range(mq_server.qzise()):
-                msg = mq_server.get_nowait()
-                if msg.prize_type in ("T", "Z"):
-                    if msg.room_id in de_dup:
-                        continue
-                    de_dup.add(msg.room_id)
-                    self._dmk_source_q.put_nowait(msg)
-                    logging.info(f"Assign task: {msg.prize_type} -> {msg.room_id}")
-                elif msg.prize_type in ("G", "S", "R", "D", "P", "A", "RAFFLE_START"):
-                    self._dmk_source_q.put_nowait(msg)
-
-            await asyncio.sleep(3)
-
-    async def process_one(self, index: int):
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"RAFFLE write behind error: {e}\n{traceback.format_exc()}")
+
+
+write_behind = RaffleWriteBehind()
+
+
+class DeDupWindow:
+    """
+    按key做时间窗口内的去重，过期的key在add时批量清理。
+    """
+    def __init__(self, window=3):
+        self.window = window
+        self._expire = {}
+        self._next_purge = 0
+
+    def add(self, key) -> bool:
+        """ 窗口内首次出现返回True """
+        now = time.monotonic()
+        if now >= self._next_purge:
+            self._expire = {k: t for k, t in self._expire.items() if t > now}
+            self._next_purge = now + self.window
+
+        if self._expire.get(key, 0) > now:
+            return False
+        self._expire[key] = now + self.window
+        return True
+
+
+class Lane:
+    """
+    一类事件的处理通道: 独立的队列与worker，worker数在[min_workers, max_workers]之间随队列长度伸缩，
+    慢的API检查不会占满其他类型事件的worker。
+    """
+    BACKLOG_PER_WORKER = 4
+    IDLE_TIMEOUT = 30
+
+    def __init__(self, name, prize_types, min_workers, max_workers):
+        self.name = name
+        self.prize_types = prize_types
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+
+        self.queue = asyncio.Queue()
+        self.workers = set()
+        self.dispatch_latency = LatencyRecorder()
+        self.exec_latency = LatencyRecorder()
+        self._worker_index = 0
+
+    def put(self, msg):
+        self.queue.put_nowait((time.monotonic(), msg))
+        if self.queue.qsize() > len(self.workers) * self.BACKLOG_PER_WORKER:
+            self._spawn()
+
+    def _spawn(self):
+        if len(self.workers) >= self.max_workers:
+            return
+        self._worker_index += 1
+        task = asyncio.create_task(self._work(self._worker_index))
+        self.workers.add(task)
+        task.add_done_callback(self.workers.discard)
+
+    async def _work(self, index):
         while True:
-            msg = await self._dmk_source_q.get()
-            start_time = time.time()
+            try:
+                enqueue_time, msg = await asyncio.wait_for(self.queue.get(), timeout=self.IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if len(self.workers) > self.min_workers:
+                    return
+                continue
 
+            self.dispatch_latency.since(enqueue_time)
+            start_time = time.monotonic()
             try:
                 executor = Executor(msg)
                 await executor.run()
             except Exception as e:
-                logging.error(f"RAFFLE worker[{index}] error: {e}\n{traceback.format_exc()}")
+                logging.error(f"RAFFLE {self.name} worker[{index}] error: {e}\n{traceback.format_exc()}")
 
-            cost_time = time.time() - start_time
+            cost_time = time.monotonic() - start_time
+            self.exec_latency.add(cost_time)
             if cost_time > 5:
-                logging.warning(f"RAFFLE worker[{index}] exec long time: {cost_time:.3f}")
+                logging.warning(f"RAFFLE {self.name} worker[{index}] exec long time: {cost_time:.3f}")
 
-    async def work(self):
-        self._workers = [
-            asyncio.create_task(self.process_one(index))
-            for index in range(8)
+    async def run(self):
+        while True:
+            while len(self.workers) < self.min_workers:
+                self._spawn()
+            await asyncio.sleep(1)
+
+    def status(self) -> dict:
+        return {
+            "queue": self.queue.qsize(),
+            "workers": len(self.workers),
+            "dispatch": self.dispatch_latency.snapshot(),
+            "exec": self.exec_latency.snapshot(),
+        }
+
+
+class RaffleProcessor:
+
+    def __init__(self):
+        self._de_dup = DeDupWindow(window=3)
+        self._lanes = [
+            # 调用BiliApi.lottery_check，慢且可能超时
+            Lane("api", ("T", "Z"), min_workers=2, max_workers=8),
+            # 写redis与mysql
+            Lane("db", ("G", "S", "R", "P", "A", "RAFFLE_START"), min_workers=2, max_workers=8),
+            # 发送QQ通知
+            Lane("notify", ("D", ), min_workers=1, max_workers=2),
         ]
-        for t in self._workers:
-            await t
+        self._lane_of_type = {t: lane for lane in self._lanes for t in lane.prize_types}
+
+    async def receive(self):
+        while True:
+            msg = await mq_source_to_raffle.get()
+            lane = self._lane_of_type.get(msg.prize_type)
+            if lane is None:
+                continue
+
+            if msg.prize_type in ("T", "Z"):
+                # T/Z只携带房间号，同一房间短时间内的多次通知只需检查一次
+                if not self._de_dup.add((msg.prize_type, msg.room_id)):
+                    continue
+                logging.info(f"Assign task: {msg.prize_type} -> {msg.room_id}")
+            lane.put(msg)
+
+    async def work(self):
+        await asyncio.gather(*[lane.run() for lane in self._lanes])
+
+    async def monitor_status(self):
+        while True:
+            await asyncio.sleep(60)
+            __monitor_info = {}
+            for lane in self._lanes:
+                status = lane.status()
+                dispatch, exec_ = status["dispatch"], status["exec"]
+                logging.info(
+                    f"RAFFLE lane {lane.name}: workers {status['workers']}, queue {status['queue']}, "
+                    f"{dispatch['count']} msgs, dispatch p50: {dispatch['p50']*1000:.1f} ms, "
+                    f"p99: {dispatch['p99']*1000:.1f} ms, exec p50: {exec_['p50']*1000:.1f} ms, "
+                    f"p99: {exec_['p99']*1000:.1f} ms"
+                )
+                __monitor_info.update({
+                    f"raffle {lane.name} queue": status["queue"],
+                    f"raffle {lane.name} workers": status["workers"],
+                    f"raffle {lane.name} dispatch p99": dispatch["p99"],
+                    f"raffle {lane.name} exec p99": exec_["p99"],
+                })
+            await MonitorWsClient.record(__monitor_info)
+
+            logging.info(f"RAFFLE de-dup: {RaffleDeDup.stats()}")
+            logging.info(f"RAFFLE redis pool: {redis_cache.pool_stats()}")
+            logging.info(f"RAFFLE redis local cache: {redis_cache.local_cache.stats()}")
+            for prize_type, recorder in Executor.timings.items():
+                t = recorder.snapshot()
+                if t["count"]:
+                    logging.info(
+                        f"RAFFLE handler {prize_type}: {t['count']} msgs, p50: {t['p50']*1000:.1f} ms, "
+                        f"p99: {t['p99']*1000:.1f} ms, max: {t['max']*1000:.1f} ms"
+                    )
 
 
 async def main():
     logging.info(f"\n{'-' * 80}\nLT PROC_RAFFLE started!\n{'-' * 80}")
     await objects.connect()
-    await mq_server.start_listen()
+    await mq_source_to_raffle.start_listen()
+    # 多个worker并发访问redis，同一tick内的命令合并发送
+    redis_cache.auto_batch = True
 
     processor = RaffleProcessor()
-    await asyncio.gather(
-        processor.receive(),
-        processor.work()
-    )
+    try:
+        await asyncio.gather(
+            processor.receive(),
+            processor.work(),
+            processor.monitor_status(),
+            write_behind.run(),
+            redis_cache.listen_invalidation(),
+        )
+    finally:
+        await write_behind.flush()
 
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(main())
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
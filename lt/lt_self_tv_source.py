@@ -1,6 +1,6 @@
 import asyncio
 import aiohttp
-from utils.udp import mq_client
+from utils.udp import mq_source_to_raffle
 from utils.biliapi import WsApi, BiliApi
 from db.tables import DMKSource
 from config.log4 import lt_server_logger as logging
@@ -32,7 +32,7 @@ async def proc_danmaku(area_id, room_id, raw_msg) -> bool:
             msg_type = danmaku.get("msg_type")
             if msg_type in (2, 8):
                 real_room_id = danmaku['real_roomid']
-                await mq_client.put(DMKSource(
+                await mq_source_to_raffle.put(DMKSource(
                     prize_type="T",
                     room_id=real_room_id
                 ))
@@ -40,7 +40,7 @@ async def proc_danmaku(area_id, room_id, raw_msg) -> bool:
 
         elif cmd == "GUARD_MSG" and danmaku["buy_type"] == 1:
             prize_room_id = danmaku['roomid']
-            await mq_client.put(DMKSource(
+            await mq_source_to_raffle.put(DMKSource(
                 prize_type="Z",
                 room_id=prize_room_id
             ))
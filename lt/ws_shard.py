@@ -0,0 +1,225 @@
+"""
+多进程分片运行ws监控。
+
+supervisor进程计算需要监控的房间，按room_id一致性哈希分配给N个worker进程；
+每个worker独立运行event loop、ws连接与弹幕解析，过滤后的事件直接发往raffle。
+worker的统计信息汇总到supervisor，再写入MonitorWsClient。
+
+    python lt/ws_shard.py --shards=4 --product
+"""
+import sys
+import time
+import queue
+import bisect
+import asyncio
+import hashlib
+import traceback
+import multiprocessing
+from config.log4 import lt_server_logger as logging
+from lt.aio_ws_source import (
+    ClientsManager,
+    DanmakuQueue,
+    WS_CODEC_PREFER,
+    get_expected_rooms,
+    danmaku_parser_process,
+)
+from utils.model import objects, MonitorWsClient
+
+
+SHARD_COUNT = multiprocessing.cpu_count()
+for _arg in sys.argv:
+    if _arg.startswith("--shards="):
+        SHARD_COUNT = int(_arg.split("=", 1)[1])
+
+# 以下统计项由各分片累加；peak为各分片峰值之和，是全局峰值的上界
+SUMMED_STATS = (
+    "msg speed",
+    "msg peak speed",
+    "broken clients",
+    "active clients",
+    "total clients",
+    "danmaku q depth",
+    "danmaku q dropped",
+)
+# 以下统计项取各分片最大值
+MAX_STATS = (
+    "danmaku q max depth",
+    "danmaku q lag avg",
+    "danmaku q lag max",
+)
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=160):
+        self._ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self._ring.append((self._hash(f"{node}#{i}"), node))
+        self._ring.sort()
+        self._keys = [k for k, _ in self._ring]
+
+    @staticmethod
+    def _hash(key) -> int:
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], "big")
+
+    def get_node(self, key):
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[index][1]
+
+    def split(self, keys) -> dict:
+        result = {node: set() for _, node in self._ring}
+        for key in keys:
+            result[self.get_node(key)].add(key)
+        return result
+
+
+async def shard_worker_main(index, room_q, stats_q, prefer):
+    loop = asyncio.get_event_loop()
+
+    async def report(info):
+        stats_q.put_nowait((index, info))
+
+    async def receive_rooms():
+        while True:
+            rooms, high_priority = await loop.run_in_executor(None, room_q.get)
+            logging.info(f"WS SHARD[{index}] receive rooms: {len(rooms)}")
+            await manager.apply_rooms(rooms, high_priority=high_priority)
+
+    danmaku_q = DanmakuQueue()
+    manager = ClientsManager(danmaku_q, prefer=prefer, reporter=report)
+    try:
+        await asyncio.gather(
+            danmaku_parser_process(danmaku_q),
+            manager.monitor_status(),
+            manager.drive_timer_wheel(),
+            receive_rooms(),
+        )
+    except Exception as e:
+        logging.error(f"WS SHARD[{index}] EXIT! Exception: {e}\n\n{traceback.format_exc()}")
+    finally:
+        await manager.close_sessions()
+
+
+def run_shard_worker(index, room_q, stats_q, prefer):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(shard_worker_main(index, room_q, stats_q, prefer))
+
+
+class ShardSupervisor:
+    def __init__(self, shard_count=SHARD_COUNT, prefer=WS_CODEC_PREFER):
+        self.shard_count = shard_count
+        self.prefer = prefer
+        self._ctx = multiprocessing.get_context("spawn")
+        self._ring = HashRing(range(shard_count))
+        self._stats_q = self._ctx.Queue()
+        self._room_qs = [self._ctx.Queue() for _ in range(shard_count)]
+        self._processes = [None] * shard_count
+        self._shard_rooms = [set() for _ in range(shard_count)]
+        self._high_priority = set()
+
+    def _start_worker(self, index):
+        p = self._ctx.Process(
+            target=run_shard_worker,
+            args=(index, self._room_qs[index], self._stats_q, self.prefer),
+            name=f"ws_shard_{index}",
+            daemon=True,
+        )
+        p.start()
+        self._processes[index] = p
+        logging.info(f"WS SHARD[{index}] started, pid: {p.pid}")
+
+    async def update_connection(self):
+        while True:
+            start_time = time.time()
+            expected, in_lottery, valuable, cache_hit_rate = await get_expected_rooms()
+            shards = self._ring.split(expected)
+            self._high_priority = in_lottery | set(valuable)
+            for index in range(self.shard_count):
+                self._shard_rooms[index] = shards[index]
+                self._room_qs[index].put((shards[index], self._high_priority & shards[index]))
+
+            __monitor_info = {
+                "valuable room": len(valuable),
+                "target clients": len(expected),
+                "valuable hit rate": cache_hit_rate,
+            }
+            await MonitorWsClient.record(__monitor_info)
+
+            logging.info(
+                f"WS SHARD SUPERVISOR UPDATE! cost: {time.time() - start_time:.3f}, "
+                f"expected: {len(expected)}, in lottery {len(in_lottery)}, valuable: {len(valuable)}, "
+                f"shards: {[len(shards[i]) for i in range(self.shard_count)]}"
+            )
+            await asyncio.sleep(60)
+
+    async def collect_stats(self):
+        loop = asyncio.get_event_loop()
+
+        def get_stats():
+            try:
+                return self._stats_q.get(timeout=1)
+            except queue.Empty:
+                return None
+
+        shard_stats = {}
+        while True:
+            r = await loop.run_in_executor(None, get_stats)
+            if r is None:
+                continue
+
+            index, info = r
+            if not any(k in info for k in SUMMED_STATS):
+                await MonitorWsClient.record(info)
+                continue
+
+            shard_stats[index] = info
+            alive = {i for i, p in enumerate(self._processes) if p and p.is_alive()}
+            if not alive.issubset(shard_stats):
+                continue
+
+            __monitor_info = {k: sum(s.get(k, 0) for s in shard_stats.values()) for k in SUMMED_STATS}
+            __monitor_info.update({k: max(s.get(k, 0) for s in shard_stats.values()) for k in MAX_STATS})
+            await MonitorWsClient.record(__monitor_info)
+            logging.info(f"WS SHARD SUPERVISOR stats from {len(shard_stats)} shards: {__monitor_info}")
+            shard_stats = {}
+
+    async def watch_workers(self):
+        while True:
+            await asyncio.sleep(10)
+            for index, p in enumerate(self._processes):
+                if p.is_alive():
+                    continue
+
+                logging.error(f"WS SHARD[{index}] died, exitcode: {p.exitcode}. restart it.")
+                self._start_worker(index)
+                rooms = self._shard_rooms[index]
+                self._room_qs[index].put((rooms, self._high_priority & rooms))
+
+    async def run(self):
+        for index in range(self.shard_count):
+            self._start_worker(index)
+
+        try:
+            await asyncio.gather(
+                self.update_connection(),
+                self.collect_stats(),
+                self.watch_workers(),
+            )
+        except Exception as e:
+            logging.error(f"WS SHARD SUPERVISOR EXIT! Exception: {e}\n\n{traceback.format_exc()}")
+        finally:
+            for p in self._processes:
+                if p and p.is_alive():
+                    p.terminate()
+
+
+async def main():
+    logging.info(f"\n{'-' * 80}\nWS SHARD SUPERVISOR started! shards: {SHARD_COUNT}\n{'-' * 80}")
+    await objects.connect()
+    await ShardSupervisor().run()
+    await objects.close()
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -11,6 +11,10 @@ import hashlib
 import traceback
 from math import floor
 from random import random
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from utils.dao import redis_cache
 from config import cloud_function_url
 from config import cloud_login
@@ -273,6 +277,11 @@ class WsApi(object):
     CONST_MESSAGE = 7
     CONST_HEART_BEAT = 2
 
+    # protover 1: 不压缩; 2: zlib; 3: brotli
+    PROTOVER_RAW = 1
+    PROTOVER_ZLIB = 2
+    PROTOVER_BROTLI = 3
+
     @classmethod
     def generate_packet(cls, action, payload=""):
         payload = payload.encode("utf-8")
@@ -305,22 +314,60 @@ class WsApi(object):
         return cls.generate_packet(cls.CONST_HEART_BEAT)
 
     @classmethod
-    def gen_join_room_pkg(cls, room_id):
+    def choose_protover(cls, prefer="bandwidth"):
+        """
+        prefer:
+            "bandwidth": brotli压缩率最高，入口带宽最小；未安装brotli时退回zlib。
+            "cpu": zlib解压开销最小。不压缩的protover 1会让每条消息单独成帧，
+                   ws帧处理和入队的开销反而更大，因此不作为选项。
+        """
+        if prefer == "bandwidth" and brotli is not None:
+            return cls.PROTOVER_BROTLI
+        return cls.PROTOVER_ZLIB
+
+    @classmethod
+    def gen_join_room_pkg(cls, room_id, protover=PROTOVER_ZLIB):
+        if protover == cls.PROTOVER_BROTLI and brotli is None:
+            logging.warning("brotli not installed, fall back to protover 2(zlib).")
+            protover = cls.PROTOVER_ZLIB
+
         uid = int(1E15 + floor(2E15 * random()))
-        package = '{"uid":%s,"roomid":%s}' % (uid, room_id)
+        package = '{"uid":%s,"roomid":%s,"protover":%s}' % (uid, room_id, protover)
         return cls.generate_packet(cls.CONST_MESSAGE, package)
 
     structure = struct.Struct("!I2H2I")
 
     @classmethod
-    def parse_msg(cls, message):
-        result = []
-        while message:
-            tuple_header = cls.structure.unpack_from(message)
-            len_data, len_header, ver, opt, seq = tuple_header
-            data = message[len_header:len_data]
-            message = message[len_data:]
+    def _iter_packets(cls, raw, offset, total):
+        unpack_from = cls.structure.unpack_from
+        while offset < total:
+            len_data, len_header, ver, opt, seq = unpack_from(raw, offset)
+            if len_data <= 0:
+                break
+            yield ver, opt, offset + len_header, offset + len_data
+            offset += len_data
+
+    @classmethod
+    def _decompress(cls, ver, data):
+        if ver == cls.PROTOVER_BROTLI:
+            return brotli.decompress(data)
+        return zlib.decompress(data)
+
+    @classmethod
+    def iter_msg(cls, message, msg_filter=None):
+        """
+        逐个解析ws帧中的消息，以生成器返回。
+
+        使用memoryview + unpack_from按offset遍历，不再对剩余buffer反复切片，
+        仅在json.loads时拷贝单条消息体。
+
+        msg_filter: DanmakuFilter，不在白名单中的消息不做json解析，直接丢弃。
+        """
+        if not isinstance(message, bytes):
+            message = bytes(message)
+        buf = memoryview(message)
 
+        for ver, opt, start, end in cls._iter_packets(message, 0, len(message)):
             if opt == 8:
                 # join
                 continue
@@ -328,25 +375,84 @@ class WsApi(object):
                 # heart beat
                 continue
             elif opt == 5:
-                if ver == 2:
-                    data = zlib.decompress(data)
-                    while data:
-                        len_data, len_header, ver, opt, seq = cls.structure.unpack_from(data[:16])
-                        start = len_header
-                        end = len_data
-                        m = json.loads(data[start:end])
-                        data = data[end:]
-                        result.append(m)
+                if ver in (cls.PROTOVER_ZLIB, cls.PROTOVER_BROTLI):
+                    data = cls._decompress(ver, buf[start:end])
+                    for _, _, inner_start, inner_end in cls._iter_packets(data, 0, len(data)):
+                        if msg_filter is not None and not msg_filter.accept(data, inner_start, inner_end):
+                            continue
+                        m = json.loads(data[inner_start:inner_end])
+                        if msg_filter is None or msg_filter.check(m):
+                            yield m
                 else:
+                    if msg_filter is not None and not msg_filter.accept(message, start, end):
+                        continue
+                    data = message[start:end]
                     try:
                         m = json.loads(data)
-                        result.append(m)
                     except Exception as e:
                         logging.error(f"e: {e}, opt5: ver: {ver} data: \n{data}\n\ntraceback: {traceback.format_exc()}")
                         continue
-        return result
+                    if msg_filter is None or msg_filter.check(m):
+                        yield m
+
+    @classmethod
+    def parse_msg(cls, message, msg_filter=None):
+        return list(cls.iter_msg(message, msg_filter=msg_filter))
+
+
+class DanmakuFilter:
+    """
+    在json解析之前按cmd过滤消息。
+
+    cmds: 关心的cmd白名单，"DANMU_MSG:4:0:2:2:2:0" 这类带后缀的cmd按 ":" 之前的部分匹配。
+    danmu_uids: 只保留这些uid发送的DANMU_MSG，为空则不限制。
+    """
+    __slots__ = ("cmds", "danmu_uids", "_uid_marks")
+
+    CMD_MARK = b'"cmd"'
+    PEEK_SIZE = 64
 
+    def __init__(self, cmds, danmu_uids=()):
+        self.cmds = frozenset(c.encode("utf-8") if isinstance(c, str) else c for c in cmds)
+        self.danmu_uids = frozenset(danmu_uids)
+        # info[2] 为 [uid, "uname", ...]
+        self._uid_marks = tuple(b'[%d,' % uid for uid in self.danmu_uids)
 
+    def accept(self, raw: bytes, start: int, end: int) -> bool:
+        index = raw.find(self.CMD_MARK, start, min(end, start + self.PEEK_SIZE))
+        if index < 0:
+            # cmd不在消息头部，交给check处理
+            return True
+
+        cmd_start = raw.find(b'"', index + len(self.CMD_MARK), end) + 1
+        cmd_end = raw.find(b'"', cmd_start, end)
+        if cmd_start <= 0 or cmd_end < 0:
+            return True
+
+        cmd = raw[cmd_start:cmd_end].split(b":", 1)[0]
+        if cmd not in self.cmds:
+            return False
+
+        if cmd == b"DANMU_MSG" and self._uid_marks:
+            body = raw[start:end]
+            return any(mark in body for mark in self._uid_marks)
+        return True
+
+    def check(self, msg: dict) -> bool:
+        cmd = msg.get("cmd")
+        if not isinstance(cmd, str):
+            return False
+
+        cmd = cmd.split(":", 1)[0]
+        if cmd.encode("utf-8") not in self.cmds:
+            return False
+
+        if cmd == "DANMU_MSG" and self.danmu_uids:
+            try:
+                return msg["info"][2][0] in self.danmu_uids
+            except (KeyError, IndexError, TypeError):
+                return False
+        return True
 
 
 class BiliApi:
@@ -1,31 +1,248 @@
 import time
 import json
+import math
+import uuid
 import random
-import pickle
 import asyncio
 import aioredis
 import configparser
-from config import REDIS_CONFIG
+import contextvars
+from array import array
+from collections import OrderedDict
+from utils import room_array
+from config import REDIS_CONFIG, REDIS_CODECS
+from utils.redis_codec import CodecRegistry, get_codec
+from utils.metrics import LatencyRecorder
 from typing import Dict, Any, Union, List, Iterable, Tuple
 
-PKL_PROTOCOL = pickle.DEFAULT_PROTOCOL
+
+# 阻塞命令会占住连接，不参与合并发送
+BLOCKING_COMMANDS = {"BLPOP", "BRPOP", "BRPOPLPUSH", "BLMOVE", "BZPOPMIN", "BZPOPMAX", "XREAD", "XREADGROUP"}
+_pipeline_enabled = contextvars.ContextVar("redis_pipeline_enabled", default=False)
+
+# 各类key的值编码，所有RedisCache默认共用；未注册的key使用pickle
+default_codecs = CodecRegistry()
+# 只在本项目内读写的key，改用json
+default_codecs.register("GIFT_TYPE_", get_codec("json"))
+default_codecs.register("LT_GUARD_INTERVAL_", get_codec("json"))
+default_codecs.register_from_config(REDIS_CODECS)
+
+
+class HotKeyCache:
+    """
+    进程内的读缓存。只缓存configure过前缀的key，每类key有各自的TTL，超过maxsize时淘汰最久未使用的key。
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._ttls = {}
+        self._data = OrderedDict()
+        self.hits = {}
+        self.misses = {}
+
+    def configure(self, prefix, ttl):
+        self._ttls[prefix] = ttl
+
+    @property
+    def prefixes(self):
+        return list(self._ttls)
+
+    def family(self, key):
+        for prefix in self._ttls:
+            if key.startswith(prefix):
+                return prefix
+        return None
+
+    def get(self, key, family, raw=False):
+        """ 返回 (是否命中, value) """
+        item = self._data.get((key, raw))
+        if item is not None and item[0] > time.time():
+            self._data.move_to_end((key, raw))
+            self.hits[family] = self.hits.get(family, 0) + 1
+            return True, item[1]
+
+        self.misses[family] = self.misses.get(family, 0) + 1
+        return False, None
+
+    def put(self, key, family, value, raw=False):
+        self._data[(key, raw)] = (time.time() + self._ttls[family], value)
+        self._data.move_to_end((key, raw))
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop((key, False), None)
+        self._data.pop((key, True), None)
+
+    def stats(self) -> dict:
+        r = {
+            family: {"hits": self.hits.get(family, 0), "misses": self.misses.get(family, 0)}
+            for family in self._ttls
+        }
+        r["size"] = len(self._data)
+        self.hits = {}
+        self.misses = {}
+        return r
 
 
 class RedisCache(object):
-    def __init__(self, host, port, db, password):
+    def __init__(self, host, port, db, password, minsize=1, maxsize=10, auto_batch=False, codecs=None):
         self.uri = f'redis://{host}:{port}'
         self.db = db
         self.password = password
+        self.minsize = minsize
+        self.maxsize = maxsize
         self.redis_conn = None
 
+        self._init_lock = None
+        self._waiting = 0
+        self.acquire_latency = LatencyRecorder()
+
+        # auto_batch为True时，同一event loop tick内的命令合并为一个pipeline发送
+        self.auto_batch = auto_batch
+        self._batch = []
+        self._batch_commands = 0
+        self._batch_round_trips = 0
+
+        self.codecs = codecs or default_codecs
+        self.local_cache = HotKeyCache()
+
+    async def _create_pool(self):
+        # 并发的首次调用只创建一个连接池
+        if self._init_lock is None:
+            self._init_lock = asyncio.Lock()
+        async with self._init_lock:
+            if self.redis_conn is None:
+                self.redis_conn = await aioredis.create_redis_pool(
+                    address=self.uri,
+                    db=self.db,
+                    password=self.password,
+                    minsize=self.minsize,
+                    maxsize=self.maxsize,
+                )
+        return self.redis_conn
+
+    async def create_dedicated_connection(self):
+        """ 不属于连接池的单独连接，供长时间阻塞的命令使用，用完后需要close """
+        return await aioredis.create_connection(address=self.uri, db=self.db, password=self.password)
+
+    async def _acquire(self, pool):
+        self._waiting += 1
+        start_time = time.monotonic()
+        try:
+            conn = await pool.acquire()
+        finally:
+            self._waiting -= 1
+        self.acquire_latency.since(start_time)
+        return conn
+
     async def execute(self, *args, **kwargs):
-        if self.redis_conn is None:
-            self.redis_conn = await aioredis.create_redis_pool(
-                address=self.uri,
-                db=self.db,
-                password=self.password
-            )
-        return await self.redis_conn.execute(*args, **kwargs)
+        blocking = str(args[0]).upper() in BLOCKING_COMMANDS
+        if (self.auto_batch or _pipeline_enabled.get()) and not blocking:
+            future = asyncio.get_event_loop().create_future()
+            self._batch.append((args, kwargs, future))
+            if len(self._batch) == 1:
+                asyncio.get_event_loop().call_soon(self._flush_batch)
+            return await future
+
+        redis_conn = self.redis_conn or await self._create_pool()
+        pool = redis_conn.connection
+        if not blocking:
+            conn, _ = pool.get_connection(args[0], args[1:])
+            if conn is not None:
+                return await redis_conn.execute(*args, **kwargs)
+
+        # 阻塞命令独占一个连接，以免阻塞其他复用该连接的命令；没有可复用的连接时也在此等待
+        conn = await self._acquire(pool)
+        try:
+            return await conn.execute(*args, **kwargs)
+        finally:
+            pool.release(conn)
+
+    def _flush_batch(self):
+        batch, self._batch = self._batch, []
+        if batch:
+            asyncio.ensure_future(self._send_batch(batch))
+
+    async def _send_batch(self, batch):
+        """ 在同一个连接上依次写入所有命令，按顺序把结果交给各自的future """
+        try:
+            redis_conn = self.redis_conn or await self._create_pool()
+            pool = redis_conn.connection
+            conn, _ = pool.get_connection(batch[0][0][0])
+            acquired = conn is None
+            if acquired:
+                conn = await self._acquire(pool)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self._batch_commands += len(batch)
+        self._batch_round_trips += 1
+        try:
+            replies = []
+            for args, kwargs, _ in batch:
+                try:
+                    replies.append(conn.execute(*args, **kwargs))
+                except Exception as e:
+                    replies.append(e)
+
+            for reply, (_, _, future) in zip(replies, batch):
+                try:
+                    result = await reply if not isinstance(reply, Exception) else reply
+                except Exception as e:
+                    result = e
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            if acquired:
+                pool.release(conn)
+
+    def pipeline(self):
+        """
+        在当前上下文(及其中创建的Task)内开启合并发送:
+
+            async with redis_cache.pipeline():
+                values = await asyncio.gather(*[redis_cache.get(k) for k in keys])
+        """
+        return _RedisPipelineContext()
+
+    def pool_stats(self) -> dict:
+        """
+        in use: 被独占的连接数。普通命令在空闲连接上复用，不计入。
+        waiting: 正在等待获取连接的调用数。
+        acquire: 自上次调用以来需要等待连接的次数与耗时。
+        """
+        pool = self.redis_conn.connection if self.redis_conn is not None else None
+        acquire = self.acquire_latency.snapshot()
+        r = {
+            "size": pool.size if pool else 0,
+            "in use": pool.size - pool.freesize if pool else 0,
+            "waiting": self._waiting,
+            "acquire count": acquire["count"],
+            "acquire p99": acquire["p99"],
+            "batched commands": self._batch_commands,
+            "batch round trips": self._batch_round_trips,
+        }
+        self._batch_commands = 0
+        self._batch_round_trips = 0
+        return r
+
+    async def execute_many(self, commands):
+        """
+        commands: [(command, *args), ...]
+        作为一个pipeline按顺序发送，只等待一次往返，返回各命令的结果
+        """
+        if not commands:
+            return []
+        async with self.pipeline():
+            return await asyncio.gather(*[self.execute(*command) for command in commands])
 
     async def close(self):
         if self.redis_conn is not None:
@@ -37,11 +254,74 @@ class RedisCache(object):
         return await self.execute("set", key, json.dumps(info), "ex", ex, "nx")
 
     async def keys(self, pattern):
-        keys = await self.execute("keys", pattern)
-        return [k.decode("utf-8") for k in keys]
+        # SCAN可能重复返回同一个key，去重并保持顺序，与KEYS一致
+        return list(dict.fromkeys([k async for k in self.scan_iter(match=pattern)]))
+
+    async def scan_iter(self, match=None, count=500):
+        """ 用SCAN逐批返回key，不阻塞redis；迭代期间一直存在的key至少返回一次，可能重复 """
+        match_args = ("MATCH", match) if match else ()
+        cursor = 0
+        while True:
+            cursor, keys = await self.execute("SCAN", cursor, *match_args, "COUNT", count)
+            for k in keys:
+                yield k.decode("utf-8")
+            if int(cursor) == 0:
+                break
+
+    async def sscan_iter(self, name, count=500, _raw=False):
+        """ 逐批返回集合中解码后的成员，_raw为True时返回未解码的成员 """
+        codec = self.codecs.for_key(name)
+        cursor = 0
+        while True:
+            cursor, members = await self.execute("SSCAN", name, cursor, "COUNT", count)
+            for m in members:
+                yield m if _raw else codec.loads(m)
+            if int(cursor) == 0:
+                break
+
+    async def hscan_iter(self, name, count=500):
+        """ 逐批返回hash中解码后的 (field, value)，field按原样返回 """
+        codec = self.codecs.for_key(name)
+        cursor = 0
+        while True:
+            cursor, pairs = await self.execute("HSCAN", name, cursor, "COUNT", count)
+            for i in range(0, len(pairs), 2):
+                yield pairs[i], codec.loads(pairs[i + 1])
+            if int(cursor) == 0:
+                break
+
+    async def zscan_iter(self, key, count=500):
+        """ 逐批返回有序集合中的 (解码后的member, score) """
+        codec = self.codecs.for_key(key)
+        cursor = 0
+        while True:
+            cursor, pairs = await self.execute("ZSCAN", key, cursor, "COUNT", count)
+            for i in range(0, len(pairs), 2):
+                yield codec.loads(pairs[i]), float(pairs[i + 1])
+            if int(cursor) == 0:
+                break
+
+    async def lrange_iter(self, name, chunk_size=500):
+        """ 按chunk_size分段LRANGE；迭代期间列表被修改时，可能重复或遗漏元素 """
+        codec = self.codecs.for_key(name)
+        start = 0
+        while True:
+            items = await self.execute("LRANGE", name, start, start + chunk_size - 1)
+            for e in items:
+                yield codec.loads(e)
+            if len(items) < chunk_size:
+                break
+            start += chunk_size
+
+    def dumps(self, key, value) -> bytes:
+        return self.codecs.for_key(key).dumps(value)
+
+    def loads(self, key, data):
+        return self.codecs.for_key(key).loads(data)
 
     async def set(self, key, value, timeout=0, _un_pickle=False):
-        v = value if _un_pickle else pickle.dumps(value)
+        self.local_cache.invalidate(key)
+        v = value if _un_pickle else self.dumps(key, value)
         if timeout > 0:
             return await self.execute("setex", key, timeout, v)
         else:
@@ -52,24 +332,59 @@ class RedisCache(object):
             return await self.execute("EXPIRE", key, timeout)
 
     async def set_if_not_exists(self, key, value, timeout=3600*24*7):
-        v = pickle.dumps(value)
+        self.local_cache.invalidate(key)
+        v = self.dumps(key, value)
         return await self.execute("set", key, v, "ex", timeout, "nx")
 
     async def delete(self, key):
+        self.local_cache.invalidate(key)
         return await self.execute("DEL", key)
 
     async def ttl(self, key):
         return await self.execute("ttl", key)
 
     async def get(self, key, _un_pickle=False):
+        family = self.local_cache.family(key)
+        if family is not None:
+            hit, value = self.local_cache.get(key, family, raw=_un_pickle)
+            if hit:
+                return value
+
         r = await self.execute("get", key)
-        if _un_pickle:
-            return r
+        if not _un_pickle and r is not None:
+            try:
+                r = self.loads(key, r)
+            except Exception:
+                pass
 
-        try:
-            return pickle.loads(r)
-        except (TypeError, pickle.UnpicklingError):
-            return r
+        # 不缓存不存在的key
+        if family is not None and r is not None:
+            self.local_cache.put(key, family, r, raw=_un_pickle)
+        return r
+
+    async def listen_invalidation(self):
+        """
+        订阅keyspace通知，其他进程修改了本地缓存的key时使之失效。
+        需要redis配置 notify-keyspace-events 包含 K 与 g$ (如 "Kg$x")，未开启时只依赖TTL。
+        """
+        while True:
+            conn = None
+            try:
+                conn = await aioredis.create_redis(self.uri, password=self.password)
+                receiver = aioredis.pubsub.Receiver()
+                await conn.psubscribe(*[
+                    receiver.pattern(f"__keyspace@{self.db}__:{prefix}*")
+                    for prefix in self.local_cache.prefixes
+                ])
+                async for _, (channel, _event) in receiver.iter():
+                    self.local_cache.invalidate(channel.decode("utf-8").split(":", 1)[1])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                await asyncio.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
 
     async def mget(self, *keys, _un_pickle=False):
         r = await self.execute("MGET", *keys)
@@ -78,99 +393,87 @@ class RedisCache(object):
             return r
 
         result = []
-        for _ in r:
+        for key, _ in zip(keys, r):
             if _ is None:
                 result.append(None)
                 continue
 
             try:
-                _ = pickle.loads(_)
-            except (TypeError, pickle.UnpicklingError):
+                _ = self.loads(key, _)
+            except Exception:
                 _ = TypeError("UnpicklingError")
             result.append(_)
         return result
 
     async def hash_map_set(self, name, key_values):
+        codec = self.codecs.for_key(name)
         args = []
         for key, value in key_values.items():
-            args.append(pickle.dumps(key))
-            args.append(pickle.dumps(value))
+            args.append(codec.dumps(key))
+            args.append(codec.dumps(value))
         return await self.execute("hmset", name, *args)
 
     async def hash_map_get(self, name, *keys):
+        codec = self.codecs.for_key(name)
         if keys:
-            r = await self.execute("hmget", name, *[pickle.dumps(k) for k in keys])
+            r = await self.execute("hmget", name, *[codec.dumps(k) for k in keys])
             if not isinstance(r, list) or len(r) != len(keys):
                 raise Exception(f"Redis hash map read error! r: {r}")
 
-            result = [pickle.loads(_) for _ in r]
+            result = [codec.loads(_) for _ in r]
             return result[0] if len(result) == 1 else result
 
         else:
-            """HDEL key field1 [field2] """
-            r = await self.execute("hgetall", name)
-            if not isinstance(r, list):
-                raise Exception(f"Redis hash map read error! r: {r}")
-
-            result = {}
-            key_temp = None
-            for index in range(len(r)):
-                if index & 1:
-                    result[pickle.loads(key_temp)] = pickle.loads(r[index])
-                else:
-                    key_temp = r[index]
-            return result
+            return {codec.loads(field): value async for field, value in self.hscan_iter(name)}
 
     async def list_push(self, name, *items):
-        r = await self.execute("LPUSH", name, *[pickle.dumps(e) for e in items])
+        codec = self.codecs.for_key(name)
+        r = await self.execute("LPUSH", name, *[codec.dumps(e) for e in items])
         return r
 
     async def list_rpop_to_another_lpush(self, source_list_name, dist_list_name):
         r = await self.execute("RPOPLPUSH", source_list_name, dist_list_name)
         if not r:
             return None
-        return pickle.loads(r)
+        return self.loads(source_list_name, r)
 
     async def list_del(self, name, item):
-        r = await self.execute("LREM", name, 0, pickle.dumps(item))
+        r = await self.execute("LREM", name, 0, self.dumps(name, item))
         return r
 
     async def list_get_all(self, name):
-        # count = await self.execute("LLEN", name)
-
-        r = await self.execute("LRANGE", name, 0, 100000)
-        if isinstance(r, list):
-            return [pickle.loads(e) for e in r]
-        return []
+        return [e async for e in self.lrange_iter(name)]
 
     async def list_rpop(self, name):
         v = await self.execute("RPOP", name)
         if v is None:
             return None
-        return pickle.loads(v)
+        return self.loads(name, v)
 
     async def list_br_pop(self, *names, timeout=10):
         r = await self.execute("BRPOP", *names, "LISTN", timeout)
         if r is None:
             return None
-        return r[0], pickle.loads(r[1])
+        return r[0], self.loads(r[0], r[1])
 
     async def set_add(self, name, *items):
-        r = await self.execute("SADD", name, *[pickle.dumps(e) for e in items])
+        codec = self.codecs.for_key(name)
+        r = await self.execute("SADD", name, *[codec.dumps(e) for e in items])
         return r
 
     async def set_remove(self, name, *items):
-        r = await self.execute("SREM", name, *[pickle.dumps(e) for e in items])
+        codec = self.codecs.for_key(name)
+        r = await self.execute("SREM", name, *[codec.dumps(e) for e in items])
         return r
 
     async def set_is_member(self, name, item):
-        return await self.execute("SISMEMBER", name, pickle.dumps(item))
+        return await self.execute("SISMEMBER", name, self.dumps(name, item))
 
     async def set_get_all(self, name):
-        r = await self.execute("SMEMBERS", name)
-        if isinstance(r, list):
-            return [pickle.loads(e) for e in r]
-        return []
+        # SSCAN可能重复返回同一成员，按编码后的值去重，与SMEMBERS一致
+        codec = self.codecs.for_key(name)
+        members = dict.fromkeys([m async for m in self.sscan_iter(name, _raw=True)])
+        return [codec.loads(m) for m in members]
 
     async def set_get_count(self, name):
         r = await self.execute("SCARD", name)
@@ -186,10 +489,11 @@ class RedisCache(object):
         ZADD key score1 member1 [score2 member2]
 
         """
+        codec = self.codecs.for_key(key)
         safe_args = []
         for member, score in member_pairs:
             if not _un_pickle:
-                member = pickle.dumps(member, protocol=PKL_PROTOCOL)
+                member = codec.dumps(member)
             safe_args.extend([float(score), member])
         return await self.execute("ZADD", key, *safe_args)
 
@@ -216,12 +520,13 @@ class RedisCache(object):
             "limit", offset, limit
         )
 
+        codec = self.codecs.for_key(key)
         return_data = []
         temp_obj = None
         for i, data in enumerate(result):
             if i % 2 == 0:  # member
                 if not _un_pickle:
-                    data = pickle.loads(data)
+                    data = codec.loads(data)
                 temp_obj = data
             else:
                 return_data.append((temp_obj, float(data)))
@@ -234,10 +539,8 @@ class RedisCache(object):
         ZREM key member [member ...]
         """
         if not _un_pickle:
-            members = [
-                pickle.dumps(m, protocol=PKL_PROTOCOL)
-                for m in members
-            ]
+            codec = self.codecs.for_key(key)
+            members = [codec.dumps(m) for m in members]
         return await self.execute("ZREM", key, *members)
 
     async def zset_zrem_by_score(
@@ -260,11 +563,28 @@ class RedisCache(object):
         ZSCORE key member
         """
         if not _un_pickle:
-            member = pickle.dumps(member, protocol=PKL_PROTOCOL)
+            member = self.dumps(key, member)
         return await self.execute("ZSCORE", key, member)
 
 
+class _RedisPipelineContext:
+    def __init__(self):
+        self._token = None
+
+    async def __aenter__(self):
+        self._token = _pipeline_enabled.set(True)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        _pipeline_enabled.reset(self._token)
+
+
 redis_cache = RedisCache(**REDIS_CONFIG)
+# 读多写少的key，允许短时间内读到旧值
+redis_cache.local_cache.configure("LT_AVAILABLE_COOKIES", ttl=30)
+redis_cache.local_cache.configure("VALUABLE_LIVE_ROOM_LIST", ttl=30)
+redis_cache.local_cache.configure("GIFT_TYPE_", ttl=600)
+redis_cache.local_cache.configure("REAL_ROOM_ID_OF_", ttl=3600)
 
 
 async def gen_x_node_redis() -> RedisCache:
@@ -276,247 +596,535 @@ async def gen_x_node_redis() -> RedisCache:
         "port": int(config["xnode_redis"]["port"]),
         "password": config["xnode_redis"]["password"],
         "db": int(config["xnode_redis"]["stormgift_db"]),
+        "minsize": config["xnode_redis"].getint("pool_minsize", fallback=1),
+        "maxsize": config["xnode_redis"].getint("pool_maxsize", fallback=10),
     })
     return redis
 
 
 class XNodeRedis:
-    def __init__(self):
-        self._x_node_redis = None
+    """
+    x-node redis。进程内共享一个客户端，首次使用时创建，之后复用连接池。
+
+    距上次检查超过HEALTH_CHECK_INTERVAL秒时先PING，失败或使用中出现连接错误时丢弃客户端，下次使用时重建。
+    """
+    HEALTH_CHECK_INTERVAL = 30
+    HEALTH_CHECK_TIMEOUT = 3
+    CONNECTION_ERRORS = (OSError, asyncio.TimeoutError, aioredis.ConnectionClosedError, aioredis.PoolClosedError)
+
+    _client = None
+    _checked_at = 0
+    _lock = None
+
+    @classmethod
+    async def get_client(cls) -> RedisCache:
+        if cls._lock is None:
+            cls._lock = asyncio.Lock()
+
+        async with cls._lock:
+            if cls._client is not None and time.time() - cls._checked_at > cls.HEALTH_CHECK_INTERVAL:
+                try:
+                    await asyncio.wait_for(cls._client.execute("PING"), timeout=cls.HEALTH_CHECK_TIMEOUT)
+                except cls.CONNECTION_ERRORS:
+                    await cls._drop()
+                else:
+                    cls._checked_at = time.time()
+
+            if cls._client is None:
+                cls._client = await gen_x_node_redis()
+                cls._checked_at = time.time()
+            return cls._client
+
+    @classmethod
+    async def _drop(cls):
+        client, cls._client = cls._client, None
+        if client is not None:
+            try:
+                await client.close()
+            except Exception:
+                pass
+
+    @classmethod
+    async def close(cls):
+        await cls._drop()
 
     async def __aenter__(self) -> RedisCache:
-        self._x_node_redis = await gen_x_node_redis()
-        return self._x_node_redis
+        return await self.get_client()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self._x_node_redis.close()
+        if exc_type is not None and issubclass(exc_type, self.CONNECTION_ERRORS):
+            await self._drop()
 
 
 class RedisLock:
-    def __init__(self, key, timeout=30):
+    """
+    分布式锁。
+
+    加锁: Lua脚本中执行 SET key token PX timeout NX，成功时在同一脚本中INCR得到递增的fencing_token，
+    下游可以用它拒绝已过期持有者的写入；token随机生成，只有持有者能续期和释放。
+    释放: Lua脚本比较token后DEL，并向 <key>_WAKE 列表LPUSH，唤醒一个BLPOP等待中的竞争者。
+    等待者在单独的连接上BLPOP，最长阻塞到当前锁的剩余过期时间，不占用连接池，也不再轮询。
+    持有期间每 timeout/3 秒续期一次。
+    """
+    ACQUIRE_SCRIPT = """
+if redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2], "NX") then
+    redis.call("DEL", KEYS[2])
+    return {1, redis.call("INCR", KEYS[3])}
+end
+return {0, redis.call("PTTL", KEYS[1])}
+"""
+    RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    redis.call("DEL", KEYS[1])
+    redis.call("LPUSH", KEYS[2], 1)
+    redis.call("PEXPIRE", KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+    RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+    # 唤醒标记只需等到BLPOP中的等待者取走，无人等待时很快过期，不会误唤醒之后的等待者
+    WAKE_TTL_MS = 1000
+
+    wait_latency = LatencyRecorder()
+    contended_count = 0
+    lost_count = 0
+
+    def __init__(self, key, timeout=30, renew=True):
         self.key = f"LT_LOCK_{key}"
         self.timeout = timeout
+        self.renew = renew
+        self.token = None
+        self.fencing_token = None
+        self.lost = False
+
+        self._wake_key = f"{self.key}_WAKE"
+        self._fence_key = f"{self.key}_FENCE"
+        self._renew_task = None
+
+    @property
+    def _timeout_ms(self):
+        return int(self.timeout * 1000)
+
+    async def acquire(self, blocking=True) -> bool:
+        start_time = time.monotonic()
+        token = uuid.uuid4().hex
+        contended = False
+        waiter = None
+        try:
+            while True:
+                acquired, value = await redis_cache.execute(
+                    "EVAL", self.ACQUIRE_SCRIPT, 3, self.key, self._wake_key, self._fence_key,
+                    token, self._timeout_ms,
+                )
+                if acquired:
+                    break
+                if not blocking:
+                    return False
+
+                contended = True
+                pttl = value
+                if pttl == -1:
+                    # 锁没有过期时间(不是由本类设置的)，无法预知何时释放，每秒重试
+                    wait = 1
+                elif pttl > 0:
+                    wait = math.ceil(pttl / 1000)
+                else:
+                    # 锁刚好过期，立即重试
+                    continue
+
+                if waiter is None:
+                    waiter = await redis_cache.create_dedicated_connection()
+                await waiter.execute("BLPOP", self._wake_key, wait)
+        finally:
+            if waiter is not None:
+                waiter.close()
+                await waiter.wait_closed()
+
+        self.token = token
+        self.lost = False
+        self.fencing_token = value
+
+        self.wait_latency.since(start_time)
+        if contended:
+            RedisLock.contended_count += 1
+        if self.renew:
+            self._renew_task = asyncio.ensure_future(self._renew_lease())
+        return True
+
+    async def _renew_lease(self):
+        while True:
+            await asyncio.sleep(self.timeout / 3)
+            try:
+                r = await redis_cache.execute(
+                    "EVAL", self.RENEW_SCRIPT, 1, self.key, self.token, self._timeout_ms
+                )
+            except Exception:
+                continue
+            if not r:
+                # 锁已过期并可能被其他持有者获取
+                self.lost = True
+                RedisLock.lost_count += 1
+                return
+
+    async def release(self) -> bool:
+        if self._renew_task is not None:
+            self._renew_task.cancel()
+            self._renew_task = None
+        if self.token is None:
+            return False
+
+        token, self.token = self.token, None
+        r = await redis_cache.execute(
+            "EVAL", self.RELEASE_SCRIPT, 2, self.key, self._wake_key, token, self.WAKE_TTL_MS
+        )
+        return bool(r)
 
     async def __aenter__(self):
-        while True:
-            lock = await redis_cache.set_if_not_exists(key=self.key, value=1, timeout=self.timeout)
-            if lock:
-                return self
-            else:
-                await asyncio.sleep(0.2 + random.random())
+        await self.acquire()
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await redis_cache.delete(self.key)
+        await self.release()
+
+    @classmethod
+    def stats(cls) -> dict:
+        """ 自上次调用以来的加锁次数、等待耗时与竞争次数 """
+        wait = cls.wait_latency.snapshot()
+        r = {
+            "acquired": wait["count"],
+            "contended": cls.contended_count,
+            "lost": cls.lost_count,
+            "wait p50": wait["p50"],
+            "wait p99": wait["p99"],
+            "wait max": wait["max"],
+        }
+        cls.contended_count = 0
+        cls.lost_count = 0
+        return r
 
 
 class ValuableLiveRoom(object):
+    """ 按价值排序的房间号，使用room_array格式存储，保持顺序 """
     _key = "VALUABLE_LIVE_ROOM_LIST"
 
     @classmethod
     async def set(cls, room_id_list):
-        if not room_id_list:
+        result = room_array.clean(room_id_list)
+        if not result:
             return False
-        value = "_".join([str(room_id) for room_id in room_id_list])
-        return await redis_cache.set(cls._key, value=value, _un_pickle=True)
+        return await redis_cache.set(cls._key, value=room_array.pack(result), _un_pickle=True)
 
     @classmethod
-    async def get_all(cls):
+    async def get_all(cls) -> array:
         value = await redis_cache.get(cls._key, _un_pickle=True)
+        if value is None:
+            return array("I")
+        if room_array.is_packed(value):
+            return room_array.unpack(value)
+        return cls._parse_legacy(value)
+
+    @staticmethod
+    def _parse_legacy(value) -> array:
+        """ 旧格式: "_"连接的房间号字符串 """
         if isinstance(value, bytes):
             value = value.decode()
-
-        if not isinstance(value, str):
-            return []
-
-        de_dup = set()
-        result = []
-        for room_id in value.split("_"):
-            try:
-                room_id = int(room_id)
-            except (TypeError, ValueError):
-                continue
-
-            if room_id <= 0:
-                continue
-
-            if room_id in de_dup:
-                continue
-            de_dup.add(room_id)
-            result.append(room_id)
-        return result
+        return room_array.clean(value.split("_"))
 
 
 class InLotteryLiveRooms(object):
-    _key = "IN_LOTTERY_LIVE_ROOM"
+    """
+    正在抽奖的房间。有序集合，成员为room_id，分数为最后一次发现抽奖的时间戳。
+    """
+    _key = "LT_IN_LOTTERY_ROOMS"
     time_out = 60*10
 
     @classmethod
     async def add(cls, room_id):
-        old = await redis_cache.get(cls._key)
-        if not isinstance(old, dict):
-            old = dict()
-
-        old[room_id] = time.time()
-        return await redis_cache.set(cls._key, old)
+        return await cls.add_many([room_id])
 
     @classmethod
-    async def get_all(cls) -> set:
-        room_dict = await redis_cache.get(cls._key)
-        if not isinstance(room_dict, dict):
-            return set()
+    async def add_many(cls, room_ids):
+        if not room_ids:
+            return 0
 
-        result = {}
         now = time.time()
-        changed = False
-        for room_id, timestamp in room_dict.items():
-            if now - timestamp < cls.time_out:
-                result[room_id] = timestamp
-            else:
-                changed = True
-
-        if changed:
-            await redis_cache.set(cls._key, result)
+        args = []
+        for room_id in room_ids:
+            args.extend([now, room_id])
+        r, *_ = await redis_cache.execute_many([
+            ("ZADD", cls._key, *args),
+            ("ZREMRANGEBYSCORE", cls._key, "-inf", now - cls.time_out),
+            ("EXPIRE", cls._key, cls.time_out),
+        ])
+        return r
 
-        return set(result.keys())
+    @classmethod
+    async def get_all(cls) -> set:
+        min_score = time.time() - cls.time_out
+        _, room_ids = await redis_cache.execute_many([
+            ("ZREMRANGEBYSCORE", cls._key, "-inf", min_score),
+            ("ZRANGEBYSCORE", cls._key, min_score, "+inf"),
+        ])
+        return {int(room_id) for room_id in room_ids}
 
 
 class MonitorLiveRooms(object):
+    """ 有序、无重复的房间号，使用room_array格式存储 """
     _key = "MonitorLiveRooms_KEY"
 
+    @classmethod
+    async def get_array(cls) -> array:
+        r = await redis_cache.get(cls._key, _un_pickle=True)
+        if r is None:
+            return array("I")
+        if room_array.is_packed(r):
+            return room_array.unpack(r)
+
+        # 旧格式: pickle的set
+        try:
+            r = redis_cache.loads(cls._key, r)
+        except Exception:
+            return array("I")
+        return room_array.to_sorted(r) if isinstance(r, set) else array("I")
+
     @classmethod
     async def get(cls) -> set:
-        r = await redis_cache.get(cls._key)
-        if not r or not isinstance(r, set):
-            return set()
-        return r
+        return set(await cls.get_array())
 
     @classmethod
     async def set(cls, live_room_id_set: set):
-        live_room_id_set = {
-            int(room_id) for room_id in live_room_id_set
-            if room_id not in (0, "0", None, "")
-        }
-        return await redis_cache.set(cls._key, live_room_id_set)
+        live_room_id_set = room_array.clean(live_room_id_set)
+        return await redis_cache.set(cls._key, room_array.pack(live_room_id_set, sort=True), _un_pickle=True)
 
 
-class RedisGuard:
-    key = "LT_GUARD"
+class RedisIndexedStore:
+    """
+    按raffle_id保存的记录。值存于hash，另有一个以过期时间为分数的有序集合作为索引，
+    过期的记录由purge_expired清理，读取全部记录时使用HSCAN，不再使用KEYS。
+    """
+    key = None
+    timeout = 24 * 3600 * 7
+
+    @classmethod
+    def _hash_key(cls):
+        return f"{cls.key}_H"
+
+    @classmethod
+    def _index_key(cls):
+        return f"{cls.key}_Z"
+
+    @classmethod
+    def _add_commands(cls, items) -> list:
+        expire_at = time.time() + cls.timeout
+        codec = redis_cache.codecs.for_key(cls._hash_key())
+        fields, index = [], []
+        for raffle_id, value in items:
+            fields.extend([raffle_id, codec.dumps(value)])
+            index.extend([expire_at, raffle_id])
+        return [("HSET", cls._hash_key(), *fields), ("ZADD", cls._index_key(), *index)]
 
     @classmethod
     async def add(cls, raffle_id, value):
-        key = f"{cls.key}_{raffle_id}"
-        await redis_cache.set(key, value, timeout=24 * 3600 * 7)
+        await cls.add_many([(raffle_id, value)])
 
     @classmethod
-    async def get_all(cls, redis=None):
-        if redis:
-            keys = await redis.keys(f"{cls.key}_*")
-            if not keys:
-                return []
+    async def add_many(cls, items):
+        """ items: [(raffle_id, value), ...] """
+        if not items:
+            return
+        await redis_cache.execute_many(cls._add_commands(items))
+        if random.random() < 0.01:
+            await cls.purge_expired(redis_cache)
 
-            values = await redis.mget(*keys)
-            return values
-        else:
+    @classmethod
+    async def purge_expired(cls, redis):
+        now = time.time()
+        expired = await redis.execute("ZRANGEBYSCORE", cls._index_key(), "-inf", now)
+        if expired:
+            await redis.execute_many([
+                ("HDEL", cls._hash_key(), *expired),
+                ("ZREMRANGEBYSCORE", cls._index_key(), "-inf", now),
+            ])
+        return len(expired)
+
+    @classmethod
+    async def iter_all(cls, redis=None, count=500):
+        """ 逐批返回全部未过期的记录，每次HSCAN约count条 """
+        if redis is None:
             async with XNodeRedis() as redis:
-                keys = await redis.keys(f"{cls.key}_*")
-                if not keys:
-                    return []
+                async for value in cls.iter_all(redis=redis, count=count):
+                    yield value
+            return
+
+        # 只读: 跳过已过期但尚未清理的记录，清理由写入端的purge_expired完成
+        expired = set(await redis.execute("ZRANGEBYSCORE", cls._index_key(), "-inf", time.time()))
+        # HSCAN可能重复返回同一个field(如rehash期间)，已返回过的跳过
+        seen = set()
+        async for raffle_id, value in redis.hscan_iter(cls._hash_key(), count=count):
+            if raffle_id in expired or raffle_id in seen:
+                continue
+            seen.add(raffle_id)
+            yield value
+
+    @classmethod
+    async def get_all(cls, redis=None):
+        return [value async for value in cls.iter_all(redis=redis)]
+
+    @classmethod
+    async def migrate_legacy(cls, redis, batch=500) -> int:
+        """ 把旧版每条记录一个的 <key>_<raffle_id> 字符串key迁入hash和索引，保留剩余过期时间，返回迁移的数量 """
+        migrated = 0
+        keys = []
+        async for key in redis.scan_iter(match=f"{cls.key}_*", count=batch):
+            # 跳过 <key>_H、<key>_Z 以及其他同前缀的key
+            if key[len(cls.key) + 1:].isdigit():
+                keys.append(key)
+            if len(keys) >= batch:
+                migrated += await cls._migrate_keys(redis, keys)
+                keys = []
+        if keys:
+            migrated += await cls._migrate_keys(redis, keys)
+        return migrated
+
+    @classmethod
+    async def _migrate_keys(cls, redis, keys) -> int:
+        result = await redis.execute_many([("GET", k) for k in keys] + [("PTTL", k) for k in keys])
+        values, ttls = result[:len(keys)], result[len(keys):]
 
-                values = await redis.mget(*keys)
-                return values
+        now = time.time()
+        fields, index = [], []
+        for key, value, pttl in zip(keys, values, ttls):
+            if value is None:
+                continue
+            raffle_id = key[len(cls.key) + 1:]
+            expire_at = now + (pttl / 1000 if pttl > 0 else cls.timeout)
+            # 值按原样复制，旧数据为pickle，hash的codec可以读取
+            fields.extend([raffle_id, value])
+            index.extend([expire_at, raffle_id])
+
+        commands = [("DEL", *keys)]
+        if fields:
+            commands = [("HSET", cls._hash_key(), *fields), ("ZADD", cls._index_key(), *index)] + commands
+        await redis.execute_many(commands)
+        return len(fields) // 2
 
     @classmethod
     async def delete(cls, *raffle_ids, redis=None):
+        if not raffle_ids:
+            return
+
+        commands = [("HDEL", cls._hash_key(), *raffle_ids), ("ZREM", cls._index_key(), *raffle_ids)]
         if redis:
-            for raffle_id in raffle_ids:
-                await redis.delete(f"{cls.key}_{raffle_id}")
+            await redis.execute_many(commands)
         else:
             async with XNodeRedis() as redis:
-                for raffle_id in raffle_ids:
-                    await redis.delete(f"{cls.key}_{raffle_id}")
+                await redis.execute_many(commands)
+
 
+class RedisGuard(RedisIndexedStore):
+    key = "LT_GUARD"
 
-class RedisRaffle:
+
+class RedisRaffle(RedisIndexedStore):
     key = "LT_RAFFLE"
 
     @classmethod
     async def add(cls, raffle_id, value, _pre=False):
-        key = f"{cls.key}_{raffle_id}"
-        await redis_cache.set(key, value, timeout=24*3600*7)
+        await cls.add_many([(raffle_id, value)], _pre=_pre)
 
+    @classmethod
+    async def add_many(cls, items, _pre=False):
+        """
+        items: [(raffle_id, value), ...]
+        _pre: 抽奖结果出来之前的记录，另存一份20分钟的缓存供RAFFLE_END时读取
+        """
         if _pre:
-            key = f"LT_PRE_RAFFLE_{raffle_id}"
-            await redis_cache.set(key, value, timeout=60*20)
+            await redis_cache.execute_many([
+                ("SETEX", f"LT_PRE_RAFFLE_{raffle_id}", 60*20, redis_cache.dumps(f"LT_PRE_RAFFLE_{raffle_id}", value))
+                for raffle_id, value in items
+            ])
+        await super().add_many(items)
 
     @classmethod
     async def get(cls, raffle_id):
         key = f"LT_PRE_RAFFLE_{raffle_id}"
         return await redis_cache.get(key)
 
-    @classmethod
-    async def get_all(cls, redis=None):
-        if redis:
-            keys = await redis.keys(f"{cls.key}_*")
-            if not keys:
-                return []
 
-            values = await redis.mget(*keys)
-            return values
-        else:
-            async with XNodeRedis() as redis:
-                keys = await redis.keys(f"{cls.key}_*")
-                if not keys:
-                    return []
+class RedisAnchor(RedisIndexedStore):
+    key = "LT_ANCHOR"
 
-                values = await redis.mget(*keys)
-                return values
 
-    @classmethod
-    async def delete(cls, *raffle_ids, redis=None):
-        if redis:
-            for raffle_id in raffle_ids:
-                await redis.delete(f"{cls.key}_{raffle_id}")
-        else:
-            async with XNodeRedis() as redis:
-                for raffle_id in raffle_ids:
-                    await redis.delete(f"{cls.key}_{raffle_id}")
+class LocalTTLSet:
+    """ 进程内的集合，元素在ttl秒后过期，超过maxsize时淘汰最早加入的元素 """
 
+    def __init__(self, ttl, maxsize=200000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
 
-class RedisAnchor:
-    key = "LT_ANCHOR"
+    def __contains__(self, key):
+        expire_at = self._data.get(key)
+        if expire_at is None:
+            return False
+        if expire_at < time.time():
+            del self._data[key]
+            return False
+        return True
 
-    @classmethod
-    async def add(cls, raffle_id, value):
-        key = f"{cls.key}_{raffle_id}"
-        await redis_cache.set(key, value, timeout=24*3600*7)
+    def add(self, key):
+        self._data[key] = time.time() + self.ttl
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
 
-    @classmethod
-    async def get_all(cls, redis=None):
-        if redis:
-            keys = await redis.keys(f"{cls.key}_*")
-            if not keys:
-                return []
+    def discard(self, key):
+        self._data.pop(key, None)
 
-            values = await redis.mget(*keys)
-            return values
-        else:
-            async with XNodeRedis() as redis:
-                keys = await redis.keys(f"{cls.key}_*")
-                if not keys:
-                    return []
+    def __len__(self):
+        return len(self._data)
+
+
+class RaffleDeDup:
+    """
+    抽奖去重。先查进程内缓存，未命中时才使用redis SET NX(多个进程共享)。
 
-                values = await redis.mget(*keys)
-                return values
+    redis中只存1字节的值，过期时间覆盖抽奖的有效期即可。
+    """
+    timeout = 3600 * 2
+    _local = LocalTTLSet(ttl=timeout)
+    local_hits = 0
+    redis_calls = 0
 
     @classmethod
-    async def delete(cls, *raffle_ids, redis=None):
-        if redis:
-            for raffle_id in raffle_ids:
-                await redis.delete(f"{cls.key}_{raffle_id}")
-        else:
-            async with XNodeRedis() as redis:
-                for raffle_id in raffle_ids:
-                    await redis.delete(f"{cls.key}_{raffle_id}")
+    async def add(cls, key) -> bool:
+        """ 第一次见到key时返回True """
+        if key in cls._local:
+            cls.local_hits += 1
+            return False
+
+        # 先标记，同一进程内的并发请求不再访问redis
+        cls._local.add(key)
+        cls.redis_calls += 1
+        try:
+            r = await redis_cache.execute("set", key, 1, "ex", cls.timeout, "nx")
+        except Exception:
+            cls._local.discard(key)
+            raise
+        return bool(r)
+
+    @classmethod
+    def stats(cls) -> dict:
+        r = {"local hits": cls.local_hits, "redis calls": cls.redis_calls, "local size": len(cls._local)}
+        cls.local_hits = 0
+        cls.redis_calls = 0
+        return r
 
 
 async def test():
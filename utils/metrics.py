@@ -0,0 +1,36 @@
+import time
+from collections import deque
+
+
+class LatencyRecorder:
+    """
+    保留最近的耗时样本(秒)，用于计算分位数。
+    """
+    def __init__(self, max_samples=10000):
+        self._samples = deque(maxlen=max_samples)
+        self.count = 0
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+
+    def since(self, start_time: float):
+        """ start_time 为 time.monotonic() 的返回值 """
+        self.add(time.monotonic() - start_time)
+
+    def snapshot(self, reset=True) -> dict:
+        ordered = sorted(self._samples)
+        if ordered:
+            r = {
+                "count": self.count,
+                "p50": ordered[int(len(ordered) * 0.5)],
+                "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+                "max": ordered[-1],
+            }
+        else:
+            r = {"count": self.count, "p50": 0.0, "p99": 0.0, "max": 0.0}
+
+        if reset:
+            self._samples.clear()
+            self.count = 0
+        return r
@@ -35,6 +35,23 @@ class MonitorWsClient(peewee.Model):
             "msg peak speed",
             "TCP ESTABLISHED",
             "TCP TIME_WAIT",
+            "danmaku q depth",
+            "danmaku q max depth",
+            "danmaku q dropped",
+            "danmaku q lag avg",
+            "danmaku q lag max",
+            "raffle api queue",
+            "raffle api workers",
+            "raffle api dispatch p99",
+            "raffle api exec p99",
+            "raffle db queue",
+            "raffle db workers",
+            "raffle db dispatch p99",
+            "raffle db exec p99",
+            "raffle notify queue",
+            "raffle notify workers",
+            "raffle notify dispatch p99",
+            "raffle notify exec p99",
         )
         update_time = params.get("update_time") or datetime.datetime.now()
         insert_params = []
@@ -152,6 +169,35 @@ class BiliUser(peewee.Model):
                 )
                 return user_obj
 
+    @classmethod
+    async def get_or_update_many(cls, users) -> dict:
+        """
+        users: [(uid, name, face), ...]
+        返回 {(uid, name): obj_id}。
+
+        常见情况(uid已存在且用户名未变、或uid为空且用户名已存在)合并为两次查询，其余的逐个走get_or_update。
+        """
+        users = {(uid, name): face for uid, name, face in users}
+        uids = {uid for uid, _ in users if uid is not None}
+        names = {name for uid, name in users if uid is None}
+
+        by_uid = {}
+        if uids:
+            for obj in await objects.execute(cls.select(cls.id, cls.uid, cls.name).where(cls.uid.in_(uids))):
+                by_uid[obj.uid] = obj
+        by_name = {}
+        if names:
+            for obj in await objects.execute(cls.select(cls.id, cls.name).where(cls.name.in_(names))):
+                by_name.setdefault(obj.name, obj)
+
+        result = {}
+        for (uid, name), face in users.items():
+            obj = by_uid.get(uid) if uid is not None else by_name.get(name)
+            if obj is None or obj.name != name:
+                obj = await cls.get_or_update(uid=uid, name=name, face=face)
+            result[(uid, name)] = obj.id
+        return result
+
     @classmethod
     async def get_by_uid(cls, uid):
         objs = await objects.execute(BiliUser.select().where(BiliUser.uid == uid))
@@ -257,6 +303,29 @@ class Guard(peewee.Model):
                 return old_rec
             return None
 
+    @classmethod
+    async def create_many(cls, params_list):
+        """ 批量写入，id重复时更新，参数同create """
+        if not params_list:
+            return
+
+        senders = await BiliUser.get_or_update_many(
+            (p["sender_uid"], p["sender_name"], p["sender_face"]) for p in params_list
+        )
+        rows = [{
+            "id": p["gift_id"],
+            "room_id": p["room_id"],
+            "gift_name": p["gift_name"],
+            "sender_obj_id": senders[(p["sender_uid"], p["sender_name"])],
+            "sender_name": p["sender_name"],
+            "created_time": p["created_time"],
+            "expire_time": p["expire_time"],
+        } for p in params_list]
+        query = cls.insert_many(rows).on_conflict(preserve=[
+            cls.room_id, cls.gift_name, cls.sender_obj_id, cls.sender_name, cls.created_time, cls.expire_time,
+        ])
+        await objects.execute(query)
+
 
 class Raffle(peewee.Model):
     id = peewee.IntegerField(primary_key=True)
@@ -320,6 +389,31 @@ class Raffle(peewee.Model):
                 return old_rec
             return None
 
+    @classmethod
+    async def record_raffle_before_result_many(cls, params_list):
+        """ 批量写入，id重复时更新，参数同record_raffle_before_result """
+        if not params_list:
+            return
+
+        senders = await BiliUser.get_or_update_many(
+            (p["sender_uid"], p["sender_name"], p["sender_face"]) for p in params_list
+        )
+        rows = [{
+            "id": p["raffle_id"],
+            "room_id": p["room_id"],
+            "gift_name": p["gift_name"],
+            "gift_type": p["gift_type"],
+            "sender_obj_id": senders[(p["sender_uid"], p["sender_name"])],
+            "sender_name": p["sender_name"],
+            "created_time": p["created_time"],
+            "expire_time": p["expire_time"],
+        } for p in params_list]
+        query = cls.insert_many(rows).on_conflict(preserve=[
+            cls.room_id, cls.gift_name, cls.gift_type, cls.sender_obj_id, cls.sender_name,
+            cls.created_time, cls.expire_time,
+        ])
+        await objects.execute(query)
+
     @classmethod
     async def create(
         cls,
@@ -0,0 +1,157 @@
+"""
+redis中值的编解码。
+
+每类key(按前缀区分)可以选择不同的codec，未注册的key使用pickle。
+非pickle的codec读取时兼容旧的pickle数据，切换codec后旧数据仍可读取，新写入的数据使用新格式。
+"""
+import json
+import pickle
+import datetime
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+PKL_PROTOCOL = pickle.DEFAULT_PROTOCOL
+
+
+def _default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if hasattr(obj, "dict"):
+        # pydantic model
+        return obj.dict()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Type is not serializable: {type(obj)}")
+
+
+def is_pickle(data) -> bool:
+    # pickle protocol 2 及以上以 PROTO(0x80) + 版本号开头
+    return len(data) >= 2 and data[0] == 0x80 and data[1] <= 5
+
+
+class ValueCodec:
+    name = None
+
+    def dumps(self, value) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PickleValueCodec(ValueCodec):
+    name = "pickle"
+
+    def dumps(self, value):
+        return pickle.dumps(value, protocol=PKL_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JsonValueCodec(ValueCodec):
+    """ datetime编码为ISO格式字符串，读取时不还原；安装了orjson时使用orjson """
+    name = "json"
+
+    def dumps(self, value):
+        if orjson is not None:
+            return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(value, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgpackValueCodec(ValueCodec):
+    """ datetime编码为ISO格式字符串，读取时不还原 """
+    name = "msgpack"
+
+    def dumps(self, value):
+        return msgpack.packb(value, default=_default, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+class IntValueCodec(ValueCodec):
+    """ 整数按十进制字符串存储，可直接INCR，其他语言也能读取 """
+    name = "int"
+
+    def dumps(self, value):
+        return b"%d" % value
+
+    def loads(self, data):
+        return int(data)
+
+
+class DualReadCodec(ValueCodec):
+    """ 写入使用primary，读取时遇到pickle数据用pickle解码 """
+
+    def __init__(self, primary: ValueCodec):
+        self.primary = primary
+        self.name = primary.name
+
+    def dumps(self, value):
+        return self.primary.dumps(value)
+
+    def loads(self, data):
+        if is_pickle(data):
+            return pickle.loads(data)
+        return self.primary.loads(data)
+
+
+PICKLE = PickleValueCodec()
+CODECS = {c.name: c for c in (PICKLE, JsonValueCodec(), IntValueCodec())}
+if msgpack is not None:
+    CODECS[MsgpackValueCodec.name] = MsgpackValueCodec()
+
+
+def get_codec(name: str, dual_read=True) -> ValueCodec:
+    codec = CODECS[name]
+    if dual_read and codec is not PICKLE:
+        return DualReadCodec(codec)
+    return codec
+
+
+class CodecRegistry:
+    """ 按key前缀选择codec，取最长匹配的前缀 """
+
+    def __init__(self, default: ValueCodec = PICKLE):
+        self.default = default
+        self._prefixes = {}
+        self._cache = {}
+
+    def register(self, prefix: str, codec: ValueCodec):
+        self._prefixes[prefix] = codec
+        self._cache.clear()
+
+    def register_from_config(self, spec: str):
+        """ spec: "GIFT_TYPE_:json, LT_GUARD_INTERVAL_:msgpack" """
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            prefix, name = item.rsplit(":", 1)
+            self.register(prefix.strip(), get_codec(name.strip()))
+
+    def for_key(self, key) -> ValueCodec:
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        codec = self._cache.get(key)
+        if codec is None:
+            codec = self.default
+            matched = ""
+            for prefix, c in self._prefixes.items():
+                if key.startswith(prefix) and len(prefix) > len(matched):
+                    codec, matched = c, prefix
+            if len(self._cache) < 10000:
+                self._cache[key] = codec
+        return codec
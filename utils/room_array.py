@@ -0,0 +1,116 @@
+"""
+房间号数组。
+
+存储格式: 头部 magic(2s) 版本(B) flags(B) + uint32小端数组，解码只需一次frombytes。
+集合运算的输入输出均为有序、无重复的 array('I')；安装了numpy时在numpy中完成，否则使用Python set。
+"""
+import sys
+import struct
+from array import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HEADER = struct.Struct("!2sBB")
+MAGIC = b"RA"
+VERSION = 1
+FLAG_SORTED = 1
+
+assert array("I").itemsize == 4
+
+
+def pack(room_ids, sort=False) -> bytes:
+    """ sort为True时去重并排序，否则保持原顺序 """
+    arr = to_sorted(room_ids) if sort else array("I", room_ids)
+    if sys.byteorder == "big":
+        arr = array("I", arr)
+        arr.byteswap()
+    return HEADER.pack(MAGIC, VERSION, FLAG_SORTED if sort else 0) + arr.tobytes()
+
+
+def clean(room_ids) -> array:
+    """ 去重并保持顺序，跳过None、非整数以及超出uint32范围的值 """
+    de_dup = set()
+    result = array("I")
+    for room_id in room_ids:
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            continue
+
+        if room_id <= 0 or room_id > 0xFFFFFFFF:
+            continue
+
+        if room_id in de_dup:
+            continue
+        de_dup.add(room_id)
+        result.append(room_id)
+    return result
+
+
+def is_packed(data) -> bool:
+    return isinstance(data, bytes) and len(data) >= HEADER.size and data[:2] == MAGIC
+
+
+def unpack(data) -> array:
+    magic, version, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Unknown room array: magic {magic}, version {version}")
+
+    arr = array("I")
+    arr.frombytes(memoryview(data)[HEADER.size:])
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+def _from_numpy(a) -> array:
+    arr = array("I")
+    arr.frombytes(a.astype(numpy.uint32).tobytes())
+    return arr
+
+
+def _as_numpy(arr):
+    if isinstance(arr, array):
+        return numpy.frombuffer(arr, dtype=numpy.uint32)
+    return numpy.asarray(arr, dtype=numpy.uint32)
+
+
+def to_sorted(room_ids) -> array:
+    """ 转为有序、无重复的数组 """
+    if numpy is not None:
+        if isinstance(room_ids, array):
+            a = _as_numpy(room_ids)
+        else:
+            a = numpy.fromiter(room_ids, dtype=numpy.uint32)
+        return _from_numpy(numpy.unique(a))
+    return array("I", sorted(set(room_ids)))
+
+
+def union(a: array, b: array) -> array:
+    if numpy is not None:
+        return _from_numpy(numpy.union1d(_as_numpy(a), _as_numpy(b)))
+    return array("I", sorted(set(a).union(b)))
+
+
+def difference(a: array, b: array) -> array:
+    if numpy is not None:
+        return _from_numpy(numpy.setdiff1d(_as_numpy(a), _as_numpy(b), assume_unique=True))
+    b = set(b)
+    return array("I", [x for x in a if x not in b])
+
+
+def intersection(a: array, b: array) -> array:
+    if numpy is not None:
+        return _from_numpy(numpy.intersect1d(_as_numpy(a), _as_numpy(b), assume_unique=True))
+    b = set(b)
+    return array("I", [x for x in a if x in b])
+
+
+def isin(values, sorted_arr: array) -> list:
+    """ values中每个元素是否在sorted_arr中，values可以无序 """
+    if numpy is not None:
+        return numpy.isin(_as_numpy(values), _as_numpy(sorted_arr), assume_unique=False).tolist()
+    s = set(sorted_arr)
+    return [x in s for x in values]
@@ -1,11 +1,134 @@
+import os
+import json
 import pickle
+import struct
 import socket
 import asyncio
+from typing import List
 from db.tables import DMKSource
+from config.log4 import lt_server_logger as logging
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 PKL_PROTOCOL = pickle.DEFAULT_PROTOCOL
 
 
+class CodecError(Exception):
+    pass
+
+
+class Codec:
+    """
+    消息编解码。编码结果为 头部 + body:
+
+        头部: magic(2s) 格式版本(B) codec_id(B) 消息数(I)
+
+    接收端按头部中的codec_id选择解码器，收发两端可以独立升级codec。
+    除pickle外，body中每条消息为 [prize_type, room_id, ts, danmaku]，不依赖Python类结构。
+    """
+    codec_id = None
+    header = struct.Struct("!2sBBI")
+    MAGIC = b"LT"
+    VERSION = 1
+
+    def encode(self, messages: List[DMKSource]) -> bytes:
+        return self.header.pack(self.MAGIC, self.VERSION, self.codec_id, len(messages)) + self.dumps(messages)
+
+    def dumps(self, messages: List[DMKSource]) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, body) -> List[DMKSource]:
+        raise NotImplementedError
+
+    @staticmethod
+    def to_row(message: DMKSource) -> list:
+        return [message.prize_type, message.room_id, message.ts, message.danmaku]
+
+    @staticmethod
+    def from_row(row) -> DMKSource:
+        prize_type, room_id, ts, danmaku = row
+        # 数据来自本机的source，跳过pydantic校验
+        return DMKSource.construct(prize_type=prize_type, room_id=room_id, ts=ts, danmaku=danmaku)
+
+    @classmethod
+    def decode(cls, data) -> List[DMKSource]:
+        if len(data) < cls.header.size:
+            raise CodecError(f"Frame too short: {len(data)}")
+
+        magic, version, codec_id, count = cls.header.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise CodecError(f"Unknown frame: magic {magic}, version {version}")
+
+        codec = CODECS.get(codec_id)
+        if codec is None:
+            raise CodecError(f"Unsupported codec: {codec_id}")
+
+        try:
+            messages = codec.loads(memoryview(data)[cls.header.size:])
+        except CodecError:
+            raise
+        except Exception as e:
+            raise CodecError(f"Cannot decode body with codec {codec_id}: {e!r}")
+        if len(messages) != count:
+            raise CodecError(f"Message count mismatch: {len(messages)} != {count}")
+        return messages
+
+
+class PickleCodec(Codec):
+    """
+    只用于编码(如与旧版对比)。反序列化pickle可以执行任意代码，接收端不注册该codec，收到codec_id为0的帧直接丢弃。
+    """
+    codec_id = 0
+
+    def dumps(self, messages):
+        return pickle.dumps(messages, protocol=PKL_PROTOCOL)
+
+    def loads(self, body):
+        raise CodecError("Pickle frames are not accepted.")
+
+
+class JsonCodec(Codec):
+    """ 安装了orjson时使用orjson """
+    codec_id = 1
+
+    def dumps(self, messages):
+        rows = [self.to_row(m) for m in messages]
+        if orjson is not None:
+            return orjson.dumps(rows)
+        return json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, body):
+        rows = orjson.loads(body) if orjson is not None else json.loads(bytes(body))
+        return [self.from_row(row) for row in rows]
+
+
+class MsgpackCodec(Codec):
+    codec_id = 2
+
+    def dumps(self, messages):
+        return msgpack.packb([self.to_row(m) for m in messages], use_bin_type=True)
+
+    def loads(self, body):
+        return [self.from_row(row) for row in msgpack.unpackb(body, raw=False)]
+
+
+# 接收端可解码的codec
+CODECS = {c.codec_id: c() for c in (JsonCodec, MsgpackCodec)}
+if msgpack is None:
+    CODECS.pop(MsgpackCodec.codec_id)
+# 本机传输更在意CPU: 有orjson时用json，否则优先msgpack
+if orjson is None and msgpack is not None:
+    default_codec = CODECS[MsgpackCodec.codec_id]
+else:
+    default_codec = CODECS[JsonCodec.codec_id]
+
+
 class UdpServer:
     def __init__(self, host: str = "127.0.0.1", port: int = 40000):
         self.host = host
@@ -28,7 +151,14 @@ class UdpServer:
                 self.transport = transport
 
             def datagram_received(self, data, addr):
-                self.data_receive_q.put_nowait(data)
+                try:
+                    messages = Codec.decode(data)
+                except Exception as e:
+                    logging.error(f"UdpServer drop invalid datagram from {addr}: {e}")
+                    return
+
+                for message in messages:
+                    self.data_receive_q.put_nowait(message)
 
         event_loop = asyncio.get_event_loop()
         self.transport, self.protocol = await event_loop.create_datagram_endpoint(
@@ -40,18 +170,17 @@ class UdpServer:
         return self._data_receive_q.qsize()
 
     def get_nowait(self) -> DMKSource:
-        r = self._data_receive_q.get_nowait()
-        return pickle.loads(r)
+        return self._data_receive_q.get_nowait()
 
     async def get(self) -> DMKSource:
-        r = await self._data_receive_q.get()
-        return pickle.loads(r)
+        return await self._data_receive_q.get()
 
 
 class UdpClient:
-    def __init__(self, host: str = "127.0.0.1", port: int = 40000):
+    def __init__(self, host: str = "127.0.0.1", port: int = 40000, codec: Codec = default_codec):
         self.host = host
         self.port = port
+        self.codec = codec
 
         self.transport = None
         self.protocol = None
@@ -80,16 +209,156 @@ class UdpClient:
         return self.transport.sendto(data)
 
     def put_nowait(self, message: DMKSource):
-        py_obj_bytes = pickle.dumps(message, protocol=PKL_PROTOCOL)
-        return self.sync_udp_client.sendto(
-            data=py_obj_bytes,
-            address=(self.host, self.port)
-        )
+        return self.sync_udp_client.sendto(self.codec.encode([message]), (self.host, self.port))
+
+    async def put(self, message: DMKSource):
+        await self._sendto(self.codec.encode([message]))
+
+
+class UnixSocketBus:
+    """
+    source -> raffle 的本地消息总线。
+
+    基于Unix域stream socket，每帧为 4字节长度 + Codec编码的消息列表；同一event loop tick内put的消息
+    合并为一帧发送。Unix域数据报的队列长度受 net.unix.max_dgram_qlen 限制(默认10)，突发时会丢消息，
+    因此使用stream。
+
+    发送端与接收端使用同一个对象: 发送端调用 put_nowait / put，接收端先 start_listen 再 get。
+    """
+    BATCH_MAX = 256
+    PENDING_MAX = 100000
+    WRITE_BUFFER_MAX = 64 * 1024 * 1024
+    frame_header = struct.Struct("!I")
+
+    def __init__(self, path: str = "/tmp/stormgift_source_to_raffle.sock", codec: Codec = default_codec):
+        self.path = path
+        self.codec = codec
+
+        self._server = None
+        self._data_receive_q = asyncio.Queue()
+
+        self._reader = None
+        self._writer = None
+        self._connecting = None
+        self._pending = []
+        self._flush_scheduled = False
+        self.dropped = 0
+
+    async def start_listen(self):
+        if self._server is not None:
+            return
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_connection, path=self.path)
+        os.chmod(self.path, 0o600)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(self.frame_header.size)
+                length, = self.frame_header.unpack(header)
+                data = await reader.readexactly(length)
+                try:
+                    messages = Codec.decode(data)
+                except CodecError as e:
+                    logging.error(f"UnixSocketBus drop invalid frame: {e}")
+                    continue
+
+                for message in messages:
+                    self._data_receive_q.put_nowait(message)
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as e:
+            logging.error(f"UnixSocketBus receive error: {e}")
+        finally:
+            writer.close()
+
+    def qzise(self) -> int:
+        return self._data_receive_q.qsize()
+
+    def get_nowait(self) -> DMKSource:
+        return self._data_receive_q.get_nowait()
+
+    async def get(self) -> DMKSource:
+        return await self._data_receive_q.get()
+
+    async def _connect(self):
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError as e:
+            logging.error(f"UnixSocketBus cannot connect to {self.path}: {e}")
+            await asyncio.sleep(1)
+        else:
+            self._reader, self._writer = reader, writer
+            asyncio.ensure_future(self._watch(reader, writer))
+        finally:
+            self._connecting = None
+        self.flush()
+
+    async def _watch(self, reader, writer):
+        """ 接收端不会发送数据，读到EOF说明接收端已关闭(如进程重启)，下次发送前重连 """
+        try:
+            await reader.read()
+        except Exception as e:
+            logging.error(f"UnixSocketBus connection error: {e}")
+        if self._writer is writer:
+            self._reader = self._writer = None
+            logging.error("UnixSocketBus receiver closed, reconnect on next flush.")
+        writer.close()
+
+    def _connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing() and not self._reader.at_eof()
+
+    def flush(self):
+        self._flush_scheduled = False
+        if not self._pending:
+            return
+
+        if not self._connected():
+            self._reader = self._writer = None
+            if len(self._pending) > self.PENDING_MAX:
+                drop_count = len(self._pending) - self.PENDING_MAX
+                self._pending = self._pending[drop_count:]
+                self.dropped += drop_count
+                logging.error(f"UnixSocketBus not connected, {drop_count} messages dropped.")
+            if self._connecting is None:
+                self._connecting = asyncio.ensure_future(self._connect())
+            return
+
+        if self._writer.transport.get_write_buffer_size() > self.WRITE_BUFFER_MAX:
+            self.dropped += len(self._pending)
+            logging.error(f"UnixSocketBus receiver too slow, {len(self._pending)} messages dropped.")
+            self._pending = []
+            return
+
+        while self._pending:
+            batch, self._pending = self._pending[:self.BATCH_MAX], self._pending[self.BATCH_MAX:]
+            data = self.codec.encode(batch)
+            try:
+                self._writer.write(self.frame_header.pack(len(data)) + data)
+            except Exception as e:
+                self.dropped += len(batch)
+                logging.error(f"UnixSocketBus write error, {len(batch)} messages dropped: {e}")
+                self._writer.close()
+                self._reader = self._writer = None
+                self.flush()
+                return
+
+    def put_nowait(self, message: DMKSource):
+        self._pending.append(message)
+        if len(self._pending) >= self.BATCH_MAX:
+            self.flush()
+        elif not self._flush_scheduled:
+            asyncio.get_event_loop().call_soon(self.flush)
+            self._flush_scheduled = True
 
     async def put(self, message: DMKSource):
-        py_obj_bytes = pickle.dumps(message, protocol=PKL_PROTOCOL)
-        await self._sendto(py_obj_bytes)
+        self.put_nowait(message)
+        if self._connected():
+            await self._writer.drain()
 
 
 mq_client = UdpClient()
 mq_server = UdpServer()
+mq_source_to_raffle = UnixSocketBus()